@@ -0,0 +1,176 @@
+import calendar
+from array import array
+from datetime import datetime, timedelta
+import numpy as np
+from models import db, MonthlyRollup
+
+ROLLING_WINDOWS = (7, 30)
+
+
+class Columns:
+    # One user's expenses bucketed per (day, category, transaction type) as
+    # parallel arrays: amount total (float64), expense count (int64), day
+    # (datetime64[D]), is_debit (bool) and category code (int32) indexing
+    # into `categories`
+    __slots__ = ('amount', 'count', 'day', 'is_debit', 'category', 'categories')
+
+    def __init__(self, amount, count, day, is_debit, category, categories):
+        self.amount = amount
+        self.count = count
+        self.day = day
+        self.is_debit = is_debit
+        self.category = category
+        self.categories = categories
+
+
+def load_columns(user_id, date_from, date_to):
+    # Bucketing happens in MongoDB, so the app only walks one row per
+    # (day, category, transaction type) however many expenses the range
+    # holds. Every series in compute() is a sum, so the buckets give the
+    # same totals as individual expenses would.
+    cursor = db.expenses.aggregate([
+        {'$match': {'user_id': user_id, 'date': {'$gte': date_from, '$lt': date_to}}},
+        {'$group': {
+            '_id': {
+                'day': {'$dateToString': {'date': '$date', 'format': '%Y-%m-%d'}},
+                'category': '$category',
+                'transaction_type': '$transaction_type'
+            },
+            'amount': {'$sum': '$amount'},
+            'count': {'$sum': 1}
+        }},
+        {'$sort': {'_id.day': 1, '_id.category': 1, '_id.transaction_type': 1}}
+    ])
+    amounts = array('d')
+    counts = array('q')
+    days = []
+    debits = array('b')
+    categories = array('i')
+    codes = {}
+    for row in cursor:
+        key = row['_id']
+        amounts.append(row['amount'])
+        counts.append(row['count'])
+        days.append(key['day'])
+        debits.append(key.get('transaction_type') == 'DR')
+        categories.append(codes.setdefault(key.get('category'), len(codes)))
+    amount = np.frombuffer(amounts, dtype=np.float64)
+    count = np.frombuffer(counts, dtype=np.int64)
+    day = np.array(days, dtype='datetime64[D]')
+    is_debit = np.frombuffer(debits, dtype=np.int8).astype(bool)
+    category = np.frombuffer(categories, dtype=np.int32)
+    return Columns(amount, count, day, is_debit, category, list(codes))
+
+
+def rolling_mean(values, window):
+    # Trailing mean over `window` days; the first days average what exists
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    index = np.arange(1, len(values) + 1)
+    start = np.maximum(index - window, 0)
+    return (sums[index] - sums[start]) / (index - start)
+
+
+def slopes(series):
+    # Least-squares slope of each row against 0..n-1, per unit of x
+    n = series.shape[1]
+    if n < 2:
+        return np.zeros(series.shape[0])
+    x = np.arange(n) - (n - 1) / 2
+    return (series - series.mean(axis=1, keepdims=True)) @ x / (x @ x)
+
+
+def month_end_projection(daily_debit, today):
+    # Fit cumulative spend for the elapsed days of this month and extend the
+    # line to the last day
+    elapsed = today.day
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    cumulative = np.cumsum(daily_debit[-elapsed:])
+    spent = float(cumulative[-1]) if elapsed else 0.0
+    if elapsed < 2:
+        projected = spent * days_in_month / max(elapsed, 1)
+    else:
+        slope, intercept = np.polyfit(np.arange(1, elapsed + 1), cumulative, 1)
+        projected = float(slope * days_in_month + intercept)
+    return {
+        'spent_to_date': round(spent, 2),
+        'projected_total': round(max(projected, spent), 2),
+        'days_elapsed': elapsed,
+        'days_in_month': days_in_month
+    }
+
+
+def _round(values):
+    return np.round(values, 2).tolist()
+
+
+def compute(user_id, start, end):
+    # Analytics for the days in [start, end] (dates). The month-end projection
+    # is only included when the range covers this month up to today.
+    date_from = datetime(start.year, start.month, start.day)
+    date_to = datetime(end.year, end.month, end.day) + timedelta(days=1)
+    columns = load_columns(user_id, date_from, date_to)
+
+    first_day = np.datetime64(start, 'D')
+    n_days = (np.datetime64(end, 'D') - first_day).astype(int) + 1
+    first_month = first_day.astype('datetime64[M]')
+    months = np.arange(first_month, np.datetime64(end, 'M') + 1)
+    n_months = len(months)
+
+    day_index = (columns.day - first_day).astype(np.int64)
+    month_index = (columns.day.astype('datetime64[M]') - first_month).astype(np.int64)
+    debit = np.where(columns.is_debit, columns.amount, 0.0)
+    credit = columns.amount - debit
+
+    daily_debit = np.bincount(day_index, weights=debit, minlength=n_days)
+    daily_credit = np.bincount(day_index, weights=credit, minlength=n_days)
+    monthly_debit = np.bincount(month_index, weights=debit, minlength=n_months)
+    monthly_credit = np.bincount(month_index, weights=credit, minlength=n_months)
+
+    # categories x months matrix of debit totals
+    n_categories = len(columns.categories)
+    by_category = np.bincount(
+        columns.category.astype(np.int64) * n_months + month_index,
+        weights=debit, minlength=n_categories * n_months
+    ).reshape(n_categories, n_months)
+    category_totals = by_category.sum(axis=1)
+    category_slopes = slopes(by_category)
+    order = np.argsort(-category_totals)
+
+    month_keys = [str(month) for month in months]
+    rollups = {row['month']: row for row in MonthlyRollup.get_range(user_id, month_keys[0], month_keys[-1])}
+    salary = np.array([rollups[key]['salary_total'] if key in rollups else 0.0 for key in month_keys])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        savings_rate = np.where(salary > 0, (salary - monthly_debit) / salary, np.nan)
+
+    result = {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'transactions': int(columns.count.sum()),
+        'daily': {
+            'dates': [str(day) for day in np.arange(first_day, first_day + n_days)],
+            'debit': _round(daily_debit),
+            'credit': _round(daily_credit),
+            'rolling': {f'{window}d': _round(rolling_mean(daily_debit, window)) for window in ROLLING_WINDOWS}
+        },
+        'monthly': {
+            'months': month_keys,
+            'debit': _round(monthly_debit),
+            'credit': _round(monthly_credit),
+            'salary': _round(salary),
+            'savings_rate': [None if np.isnan(rate) else round(float(rate), 4) for rate in savings_rate]
+        },
+        'categories': [
+            {
+                'name': columns.categories[i],
+                'total': round(float(category_totals[i]), 2),
+                'monthly': _round(by_category[i]),
+                # Change in monthly spend per month over the range
+                'trend': round(float(category_slopes[i]), 2)
+            }
+            for i in order if category_totals[i] > 0
+        ],
+        'projection': None
+    }
+    if end == datetime.now().date() and n_days >= end.day:
+        result['projection'] = month_end_projection(daily_debit, end)
+    return result
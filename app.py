@@ -1,64 +1,107 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Blueprint, Response, current_app, g, request, make_response
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from datetime import datetime, timedelta
 import os
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import User, Expense, Salary, db, Category
+import models
+from models import User, Expense, Salary, db, Category, MonthlyRollup, DataVersion, Tombstone, RefreshToken, SearchTerm, user_cache
+from cache import create_cache
+from config import load_config, mongo_client_options, write_behind_concern
+from writebehind import WriteBehindQueue, QueueFull
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from flask_cors import CORS
 import jwt
+import json
+import base64
+import hmac
+import csv
+import codecs
+import time
+import io
+import calendar
+import analytics
+import logs
+from logs import Payload
+import metrics
+import ratelimit
+import serialization
+from serialization import jsonify
 from functools import wraps
 from bson import ObjectId
 
-app = Flask(__name__)
-CORS(app, 
-     supports_credentials=True,
-     resources={r"/api/*": {
-         "origins": "*",  # Allow all origins
-         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-         "allow_headers": ["Content-Type", "Authorization"],
-         "expose_headers": ["Content-Type", "Authorization"],
-         "max_age": 3600
-     }}
-)
-
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
-app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+api = Blueprint('api', __name__)
+login_manager = LoginManager()
 
 # Error handlers
-@app.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized(error):
     return jsonify({'message': 'Unauthorized access'}), 401
 
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return jsonify({'message': 'Resource not found'}), 404
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def internal_error(error):
     return jsonify({'message': 'Internal server error'}), 500
 
-login_manager = LoginManager()
-login_manager.init_app(app)
-
 def generate_token(user):
     try:
         payload = {
             'user_id': user.id,
             'email': user.email,
-            'exp': datetime.utcnow() + app.config['JWT_ACCESS_TOKEN_EXPIRES']
+            'exp': datetime.utcnow() + current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
         }
-        app.logger.debug(f"Generating token with payload: {payload}")
-        token = jwt.encode(payload, app.config['JWT_SECRET_KEY'], algorithm='HS256')
-        app.logger.debug(f"Generated token: {token}")
-        return token
+        return jwt.encode(payload, current_app.config['JWT_SECRET_KEY'], algorithm='HS256')
     except Exception as e:
-        app.logger.error(f"Error generating token: {str(e)}")
+        current_app.logger.error('Error generating token: %s', e)
         raise
 
+def generate_refresh_token(user):
+    return RefreshToken.issue(user.id, current_app.config['JWT_REFRESH_TOKEN_EXPIRES'])
+
+# Sub-requests of /api/batch carry the already authenticated user in their
+# WSGI environ; clients cannot set environ keys, only headers
+BATCH_USER_KEY = 'moneytracker.batch_user'
+
+def rate_limit(scope, key):
+    # Returns a 429 response when the caller's bucket is empty, else None
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is None:
+        return None
+    wait = limiter.hit(scope, key, request.endpoint)
+    if not wait:
+        return None
+    response = jsonify({'message': 'Too many requests'})
+    response.status_code = 429
+    response.headers['Retry-After'] = ratelimit.retry_after(wait)
+    return response
+
+def ip_rate_limited(f):
+    # For endpoints that run before a user is known
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        limited = rate_limit('ip', request.remote_addr)
+        if limited is not None:
+            return limited
+        return f(*args, **kwargs)
+
+    return decorated
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
+        user = request.environ.get(BATCH_USER_KEY)
+        if user is not None:
+            # Batch sub-requests are charged like standalone requests
+            limited = rate_limit('user', user.id)
+            if limited is not None:
+                return limited
+            return f(user, *args, **kwargs)
+
         token = None
         auth_header = request.headers.get('Authorization')
         
@@ -71,7 +114,7 @@ def token_required(f):
         try:
             payload = jwt.decode(
                 token,
-                app.config['JWT_SECRET_KEY'],
+                current_app.config['JWT_SECRET_KEY'],
                 algorithms=['HS256'],
                 options={
                     'verify_signature': True,
@@ -79,22 +122,102 @@ def token_required(f):
                     'require': ['exp', 'user_id', 'email']
                 }
             )
-            user = User.get(payload['user_id'])
-            if not user:
-                return jsonify({'message': 'User not found'}), 401
-            return f(user, *args, **kwargs)
+            user = User.get_cached(payload['user_id'])
         except Exception as e:
-            app.logger.error(f"Token validation error: {str(e)}")
+            current_app.logger.warning('Token validation error: %s', e)
             return jsonify({'message': 'Invalid token'}), 401
+        if not user:
+            return jsonify({'message': 'User not found'}), 401
+        limited = rate_limit('user', user.id)
+        if limited is not None:
+            return limited
+        return f(user, *args, **kwargs)
             
     return decorated
 
+def versioned(f):
+    # Serve GET responses with an ETag derived from the user's data version so
+    # polling clients get 304 Not Modified without the view running at all.
+    # Other clients are served from the response cache, if one is configured,
+    # under the same version. Must be applied below token_required.
+    @wraps(f)
+    def decorated(user, *args, **kwargs):
+        user_version, global_version, settled = DataVersion.get(user.id)
+        g.data_version = (user_version, global_version)
+        if not settled:
+            # A write is in flight, so the data may not match any version yet:
+            # serve it without an ETag and keep it out of the cache
+            response = make_response(f(user, *args, **kwargs))
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        # Summaries depend on the current month and day (avg_daily_spend)
+        etag = f"{user_version}.{global_version}.{datetime.now().strftime('%Y-%m-%d')}"
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response_cache = current_app.extensions.get('response_cache')
+            key = f"{request.full_path}|{user.id}|{etag}"
+            body = response_cache.get(key) if response_cache is not None else None
+            if body is not None:
+                response = current_app.response_class(body, mimetype='application/json')
+            else:
+                response = make_response(f(user, *args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if response_cache is not None:
+                    # Older versions of the key are never read again and age out
+                    response_cache.set(key, response.get_data())
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    return decorated
+
+def category_to_dict(cat):
+    return {
+        'id': str(cat['_id']),
+        'name': cat['name'],
+        'is_global': cat.get('is_global', False)
+    }
+
+def encode_cursor(key):
+    # Opaque pagination cursor built from the (date, _id) of the last row
+    date, expense_id = key
+    raw = json.dumps({'d': date.isoformat(), 'i': str(expense_id)})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(raw['d']), ObjectId(raw['i'])
+
+def parse_date_param(value, end=False):
+    # A date-only upper bound includes the whole day
+    date = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        date += timedelta(days=1)
+    return date
+
+def parse_limit(value):
+    # Page size from a `limit` query parameter; raises ValueError with the
+    # message to return to the client
+    if value is None:
+        return current_app.config['EXPENSES_PAGE_SIZE']
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('Invalid limit value')
+    maximum = current_app.config['EXPENSES_MAX_PAGE_SIZE']
+    if limit < 1 or limit > maximum:
+        raise ValueError('Limit must be between 1 and %d' % maximum)
+    return limit
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.get(user_id)
 
 # API Routes
-@app.route('/api/login', methods=['POST'])
+@api.route('/api/login', methods=['POST'])
+@ip_rate_limited
 def login():
     data = request.get_json()
     email = data.get('email')
@@ -111,12 +234,14 @@ def login():
                 'username': user.username,
                 'email': user.email
             },
-            'token': token
+            'token': token,
+            'refresh_token': generate_refresh_token(user)
         })
     else:
         return jsonify({'message': 'Invalid email or password'}), 401
 
-@app.route('/api/register', methods=['POST'])
+@api.route('/api/register', methods=['POST'])
+@ip_rate_limited
 def register():
     data = request.get_json()
     email = data.get('email')
@@ -155,141 +280,355 @@ def register():
             'email': user.email,
             'username': user.username
         },
-        'token': token
+        'token': token,
+        'refresh_token': generate_refresh_token(user)
     }), 201
 
-@app.route('/api/logout', methods=['POST'])
+@api.route('/api/token/refresh', methods=['POST'])
+@ip_rate_limited
+def refresh_token():
+    # Trade a refresh token for a new access token and a new refresh token;
+    # the old refresh token stops working
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if not token:
+        return jsonify({'message': 'Refresh token is missing'}), 400
+
+    rotated = RefreshToken.rotate(token, current_app.config['JWT_REFRESH_TOKEN_EXPIRES'])
+    if not rotated:
+        return jsonify({'message': 'Invalid refresh token'}), 401
+    user_id, new_refresh_token = rotated
+    user = User.get_cached(user_id)
+    if not user:
+        return jsonify({'message': 'User not found'}), 401
+    return jsonify({
+        'token': generate_token(user),
+        'refresh_token': new_refresh_token
+    })
+
+@api.route('/api/logout', methods=['POST'])
 @token_required
 def logout(user):
+    # Revokes the given refresh token (this device), or all of the user's
+    # refresh tokens with {"all": true} or when none is given. Access tokens
+    # stay valid until they expire.
+    data = request.get_json(silent=True) or {}
+    token = data.get('refresh_token')
+    if token and not data.get('all'):
+        RefreshToken.revoke(token, user.id)
+    else:
+        RefreshToken.revoke_all(user.id)
     return jsonify({'message': 'Logout successful'})
 
-@app.route('/api/dashboard', methods=['GET'])
+@api.route('/api/dashboard', methods=['GET'])
 @token_required
+@versioned
 def get_dashboard(user):
     try:
-        app.logger.info(f"Fetching dashboard data for user: {user.email}")
-        expenses = Expense.get_by_user(user.id)
-        app.logger.debug(f"Found {len(expenses)} expenses")
+        current_app.logger.info('Fetching dashboard data for user %s', user.id)
+        expenses, next_key = Expense.get_page(user.id, current_app.config['EXPENSES_PAGE_SIZE'])
 
         current_date = datetime.now()
-        current_month = current_date.month
-        current_year = current_date.year
-
-        # Filter expenses for current month
-        current_month_expenses = [
-            expense for expense in expenses
-            if expense.date.month == current_month and expense.date.year == current_year
-        ]
+        summary = MonthlyRollup.get(user.id, MonthlyRollup.month_key(current_date))
 
-        total_credit = sum(expense.amount for expense in current_month_expenses if expense.transaction_type == 'CR')
-        total_debit = sum(expense.amount for expense in current_month_expenses if expense.transaction_type == 'DR')
+        total_credit = summary['credit_total']
+        total_debit = summary['debit_total']
 
         days_in_month = current_date.day
         avg_daily_spend = total_debit / days_in_month if days_in_month > 0 else 0
 
-        # Calculate category-wise spending for current month
-        category_spending = {}
-        for expense in current_month_expenses:
-            if expense.transaction_type == 'DR':
-                category = expense.category
-                if category not in category_spending:
-                    category_spending[category] = 0
-                category_spending[category] += expense.amount
-
         response_data = {
             'total_credit': total_credit,
             'total_debit': total_debit,
             'avg_daily_spend': avg_daily_spend,
             'current_month_name': current_date.strftime('%B %Y'),
-            'category_spending': category_spending,
-            'expenses': [{
-                'id': expense.id,
-                'amount': expense.amount,
-                'category': expense.category,
-                'description': expense.description,
-                'date': expense.date.isoformat(),
-                'transaction_type': expense.transaction_type,
-                'timestamp': expense.timestamp.isoformat() if expense.timestamp else None
-            } for expense in expenses]
+            'category_spending': summary['category_spending'],
+            'expenses': expenses,
+            'next_cursor': encode_cursor(next_key) if next_key else None
         }
-        app.logger.debug(f"Dashboard response data: {response_data}")
+        current_app.logger.debug('Dashboard response data: %s', Payload(response_data))
 
         return jsonify(response_data)
     except Exception as e:
-        app.logger.error(f"Error fetching dashboard data: {str(e)}", exc_info=True)
+        current_app.logger.error('Error fetching dashboard data: %s', e, exc_info=True)
         return jsonify({'message': 'Error fetching dashboard data', 'error': str(e)}), 500
 
-@app.route('/api/expenses', methods=['POST'])
+def write_queue_full():
+    # Backpressure from the write-behind queue
+    response = jsonify({'message': 'Server is busy, please retry'})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+def validate_expense(data):
+    # Returns (fields, None) for a valid expense payload or (None, error)
+    # where error is the JSON body to send back
+    required_fields = ['amount', 'category', 'date', 'transaction_type']
+    missing_fields = [field for field in required_fields if field not in data]
+    if missing_fields:
+        return None, {
+            'message': 'Missing required fields',
+            'missing_fields': missing_fields
+        }
+
+    # Validate and convert amount
+    try:
+        amount = float(data['amount'])
+    except (ValueError, TypeError):
+        return None, {'message': 'Invalid amount value'}
+
+    # Category names become rollup field names and search terms
+    if not isinstance(data['category'], str) or not data['category'].strip():
+        return None, {'message': 'Category must be a non-empty string'}
+
+    if not isinstance(data.get('description') or '', str):
+        return None, {'message': 'Description must be a string'}
+
+    # Validate transaction type
+    if data['transaction_type'] not in ['CR', 'DR']:
+        return None, {
+            'message': 'Invalid transaction type',
+            'valid_types': ['CR', 'DR']
+        }
+
+    # Validate and parse date
+    try:
+        date = datetime.fromisoformat(data['date'])
+    except (ValueError, TypeError):
+        return None, {'message': 'Invalid date format. Use ISO format (YYYY-MM-DD)'}
+
+    return {
+        'amount': amount,
+        'category': data['category'],
+        'description': data.get('description') or '',
+        'date': date,
+        'transaction_type': data['transaction_type']
+    }, None
+
+@api.route('/api/expenses', methods=['GET'])
+@token_required
+def list_expenses(user):
+    args = request.args
+    try:
+        limit = parse_limit(args.get('limit'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        after = decode_cursor(args['cursor']) if args.get('cursor') else None
+    except Exception:
+        return jsonify({'message': 'Invalid cursor'}), 400
+
+    try:
+        date_from = parse_date_param(args['from']) if args.get('from') else None
+        date_to = parse_date_param(args['to'], end=True) if args.get('to') else None
+    except ValueError:
+        return jsonify({'message': 'Invalid date format. Use ISO format (YYYY-MM-DD)'}), 400
+
+    transaction_type = args.get('transaction_type')
+    if transaction_type and transaction_type not in ['CR', 'DR']:
+        return jsonify({
+            'message': 'Invalid transaction type',
+            'valid_types': ['CR', 'DR']
+        }), 400
+
+    try:
+        expenses, next_key = Expense.get_page(
+            user.id, limit, after=after, date_from=date_from, date_to=date_to,
+            category=args.get('category'), transaction_type=transaction_type
+        )
+        return jsonify({
+            'expenses': expenses,
+            'next_cursor': encode_cursor(next_key) if next_key else None
+        })
+    except Exception as e:
+        current_app.logger.error('Error listing expenses: %s', e, exc_info=True)
+        return jsonify({'message': 'Error listing expenses', 'error': str(e)}), 500
+
+@api.route('/api/expenses', methods=['POST'])
 @token_required
 def add_expense(user):
     try:
-        app.logger.info(f"Adding expense for user: {user.email}")
+        current_app.logger.info('Adding expense for user %s', user.id)
         data = request.get_json()
-        app.logger.debug(f"Request data: {data}")
+        current_app.logger.debug('Request data: %s', Payload(data))
         
         if not data:
-            app.logger.error("No data provided in request")
+            current_app.logger.warning('No data provided in request')
             return jsonify({'message': 'No data provided'}), 400
 
-        # Validate required fields
-        required_fields = ['amount', 'category', 'date', 'transaction_type']
-        missing_fields = [field for field in required_fields if field not in data]
-        if missing_fields:
-            app.logger.error(f"Missing required fields: {missing_fields}")
-            return jsonify({
-                'message': 'Missing required fields',
-                'missing_fields': missing_fields
-            }), 400
-
-        # Validate and convert amount
-        try:
-            amount = float(data['amount'])
-            app.logger.debug(f"Amount validated: {amount}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid amount value: {data['amount']}")
-            return jsonify({'message': 'Invalid amount value'}), 400
-
-        # Validate transaction type
-        if data['transaction_type'] not in ['CR', 'DR']:
-            app.logger.error(f"Invalid transaction type: {data['transaction_type']}")
-            return jsonify({
-                'message': 'Invalid transaction type',
-                'valid_types': ['CR', 'DR']
-            }), 400
-
-        # Validate and parse date
-        try:
-            date = datetime.fromisoformat(data['date'])
-            app.logger.debug(f"Date validated: {date}")
-        except (ValueError, TypeError):
-            app.logger.error(f"Invalid date format: {data['date']}")
-            return jsonify({'message': 'Invalid date format. Use ISO format (YYYY-MM-DD)'}), 400
+        expense_fields, error = validate_expense(data)
+        if error:
+            current_app.logger.warning('Invalid expense data: %s', error['message'])
+            return jsonify(error), 400
 
-        # Get optional fields with defaults
-        category = data['category']
-        description = data.get('description', '')
+        amount = expense_fields['amount']
+        category = expense_fields['category']
+        description = expense_fields['description']
+        date = expense_fields['date']
+        transaction_type = expense_fields['transaction_type']
         
-        app.logger.info(f"Creating expense: amount={amount}, category={category}, date={date}, type={data['transaction_type']}")
-        expense = Expense.create(amount, category, description, date, data['transaction_type'], user.id)
-        app.logger.info(f"Expense created successfully with ID: {expense.id}")
+        current_app.logger.debug('Creating expense: amount=%s, category=%s, date=%s, type=%s',
+                                 amount, category, date, transaction_type)
+        expense = Expense.create(amount, category, description, date, transaction_type, user.id)
+        current_app.logger.info('Expense created with ID %s', expense.id)
         
         return jsonify({
             'message': 'Expense added successfully',
-            'expense': {
-                'id': expense.id,
-                'amount': expense.amount,
-                'category': expense.category,
-                'description': expense.description,
-                'date': expense.date.isoformat(),
-                'transaction_type': expense.transaction_type,
-                'timestamp': expense.timestamp.isoformat() if expense.timestamp else None
-            }
+            'expense': expense
         }), 201
+    except QueueFull:
+        return write_queue_full()
     except Exception as e:
-        app.logger.error(f"Error adding expense: {str(e)}", exc_info=True)
+        current_app.logger.error('Error adding expense: %s', e, exc_info=True)
         return jsonify({'message': 'Error adding expense', 'error': str(e)}), 500
 
-@app.route('/api/salary', methods=['POST'])
+@api.route('/api/expenses/bulk', methods=['POST'])
+@token_required
+def bulk_add_expenses(user):
+    # Accepts a JSON array of expenses, a multipart CSV upload in the "file"
+    # field or a text/csv body. Rows are validated like POST /api/expenses
+    # and inserted in batches; errors are reported by 0-based row index.
+    if request.mimetype == 'application/json':
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return jsonify({'message': 'Expected a JSON array of expenses'}), 400
+    elif 'file' in request.files:
+        rows = csv.DictReader(codecs.iterdecode(request.files['file'].stream, 'utf-8-sig'))
+    elif request.mimetype == 'text/csv':
+        rows = csv.DictReader(codecs.iterdecode(request.stream, 'utf-8-sig'))
+    else:
+        return jsonify({'message': 'Send a JSON array or a CSV file'}), 415
+
+    inserted = 0
+    errors = []
+    batch = []
+    batch_rows = []
+
+    def flush():
+        count, failed = Expense.create_many(user.id, batch)
+        for index, message in failed:
+            errors.append({'row': batch_rows[index], 'message': message})
+        batch.clear()
+        batch_rows.clear()
+        return count
+
+    try:
+        for index, row in enumerate(rows):
+            if index >= current_app.config['BULK_MAX_ROWS']:
+                errors.append({'row': index, 'message': 'Too many rows, limit is %d' % current_app.config['BULK_MAX_ROWS']})
+                break
+            if not isinstance(row, dict):
+                errors.append({'row': index, 'message': 'Expected an object'})
+                continue
+            # CSV rows with missing trailing columns have None values
+            expense_fields, error = validate_expense({k: v for k, v in row.items() if v is not None})
+            if error:
+                errors.append(dict(error, row=index))
+                continue
+            batch.append(expense_fields)
+            batch_rows.append(index)
+            if len(batch) >= current_app.config['BULK_BATCH_SIZE']:
+                inserted += flush()
+        if batch:
+            inserted += flush()
+    except (UnicodeDecodeError, csv.Error) as e:
+        errors.append({'row': None, 'message': f'Could not read CSV: {e}'})
+    except Exception as e:
+        current_app.logger.error('Error importing expenses: %s', e, exc_info=True)
+        return jsonify({'message': 'Error importing expenses', 'error': str(e), 'inserted': inserted}), 500
+
+    return jsonify({
+        'message': 'Import finished',
+        'inserted': inserted,
+        'errors': errors
+    }), 201 if inserted else 400
+
+EXPORT_FIELDS = ['id', 'date', 'amount', 'category', 'description', 'transaction_type', 'timestamp']
+
+def export_csv(expenses, batch_size):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for count, expense in enumerate(expenses, 1):
+        writer.writerow(expense.to_dict())
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def export_ndjson(expenses, batch_size):
+    lines = []
+    for expense in expenses:
+        lines.append(serialization.dumps(expense).decode())
+        if len(lines) >= batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+@api.route('/api/expenses/search', methods=['GET'])
+@token_required
+def search_expenses(user):
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'message': 'Search query is required'}), 400
+    try:
+        limit = parse_limit(request.args.get('limit'))
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    try:
+        return jsonify({'expenses': Expense.search(user.id, query, limit)})
+    except Exception as e:
+        current_app.logger.error('Error searching expenses: %s', e, exc_info=True)
+        return jsonify({'message': 'Error searching expenses', 'error': str(e)}), 500
+
+@api.route('/api/expenses/suggest', methods=['GET'])
+@token_required
+def suggest_terms(user):
+    # Autocomplete for descriptions and category names by prefix
+    prefix = request.args.get('prefix', '')
+    kind = request.args.get('kind')
+    if not prefix.strip():
+        return jsonify({'message': 'Prefix is required'}), 400
+    if kind and kind not in SearchTerm.KINDS:
+        return jsonify({'message': 'Invalid kind', 'valid_kinds': list(SearchTerm.KINDS)}), 400
+
+    terms = SearchTerm.suggest(user.id, prefix, kind, current_app.config['SUGGEST_LIMIT'])
+    return jsonify({
+        'suggestions': [{'text': term['display'], 'kind': term['kind'], 'count': term['count']} for term in terms]
+    })
+
+@api.route('/api/expenses/export', methods=['GET'])
+@token_required
+def export_expenses(user):
+    # Streams the ledger straight from the cursor so memory stays flat
+    # regardless of how many transactions the user has
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ['csv', 'ndjson']:
+        return jsonify({'message': 'Invalid format', 'valid_formats': ['csv', 'ndjson']}), 400
+    try:
+        date_from = parse_date_param(request.args['from']) if request.args.get('from') else None
+        date_to = parse_date_param(request.args['to'], end=True) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({'message': 'Invalid date format. Use ISO format (YYYY-MM-DD)'}), 400
+
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    # Only fetch exported fields; 'id' comes from _id, which is always returned
+    fields = [field for field in EXPORT_FIELDS if field != 'id']
+    expenses = Expense.iter_range(user.id, date_from, date_to, fields=fields, batch_size=batch_size)
+    if export_format == 'csv':
+        body, mimetype = export_csv(expenses, batch_size), 'text/csv'
+    else:
+        body, mimetype = export_ndjson(expenses, batch_size), 'application/x-ndjson'
+    filename = f"expenses-{datetime.now().strftime('%Y%m%d')}.{export_format}"
+    return Response(body, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+
+@api.route('/api/salary', methods=['POST'])
 @token_required
 def add_salary(user):
     try:
@@ -322,107 +661,252 @@ def add_salary(user):
         
         return jsonify({
             'message': 'Salary added successfully',
-            'salary': {
-                'id': salary.id,
-                'amount': salary.amount,
-                'date': salary.date.isoformat()
-            }
+            'salary': salary
         }), 201
+    except QueueFull:
+        return write_queue_full()
     except Exception as e:
-        app.logger.error(f"Error adding salary: {str(e)}")
+        current_app.logger.error('Error adding salary: %s', e)
         return jsonify({'message': 'Error adding salary', 'error': str(e)}), 500
 
-@app.route('/api/expenses/<id>', methods=['DELETE'])
+@api.route('/api/expenses/<id>', methods=['DELETE'])
 @token_required
 def delete_expense(user, id):
     Expense.delete(id, user.id)
     return jsonify({'message': 'Expense deleted successfully'})
 
-@app.route('/api/salary/<id>', methods=['DELETE'])
+@api.route('/api/salary/<id>', methods=['DELETE'])
 @token_required
 def delete_salary(user, id):
     Salary.delete(id, user.id)
     return jsonify({'message': 'Salary deleted successfully'})
 
-@app.route('/api/salary/visualization', methods=['GET'])
+@api.route('/api/salary/visualization', methods=['GET'])
 @token_required
+@versioned
 def get_salary_visualization(user):
-    salaries = Salary.get_by_user(user.id)
-    expenses = Expense.get_by_user(user.id)
-    
-    # Group salaries by month
-    monthly_salaries = {}
-    for salary in salaries:
-        month = salary.date.strftime('%Y-%m')
-        if month not in monthly_salaries:
-            monthly_salaries[month] = 0
-        monthly_salaries[month] += salary.amount
-    
-    # Sort by month
-    sorted_months = sorted(monthly_salaries.keys())
-    
-    # Get current month data
+    # Optional month range as YYYY-MM; the current month totals are always included
+    start_month = request.args.get('from')
+    end_month = request.args.get('to')
+    try:
+        for month in (start_month, end_month):
+            if month:
+                datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'message': 'Invalid month format. Use YYYY-MM'}), 400
+
     current_date = datetime.now()
-    current_month = current_date.strftime('%Y-%m')
-    
-    current_month_salary = monthly_salaries.get(current_month, 0)
-    current_month_credits = sum(
-        expense.amount for expense in expenses 
-        if expense.date.strftime('%Y-%m') == current_month 
-        and expense.transaction_type == 'CR'
+    overview = MonthlyRollup.get_salary_overview(
+        user.id, MonthlyRollup.month_key(current_date), start_month, end_month
     )
-    current_month_debits = sum(
-        expense.amount for expense in expenses 
-        if expense.date.strftime('%Y-%m') == current_month 
-        and expense.transaction_type == 'DR'
-    )
-    
+
     return jsonify({
         'salary_data': {
-            'months': [datetime.strptime(month, '%Y-%m').strftime('%b %Y') for month in sorted_months],
-            'amounts': [monthly_salaries[month] for month in sorted_months]
+            'months': [f"{calendar.month_abbr[int(month[5:])]} {month[:4]}" for month, _ in overview['salaries']],
+            'amounts': [amount for _, amount in overview['salaries']]
         },
-        'current_salary': current_month_salary,
+        'current_salary': overview['current_salary'],
         'current_month_name': current_date.strftime('%B %Y'),
-        'total_credits': current_month_credits,
-        'total_debits': current_month_debits
+        'total_credits': overview['current_credits'],
+        'total_debits': overview['current_debits']
     })
 
-@app.route('/api/health')
+@api.route('/api/analytics', methods=['GET'])
+@token_required
+@versioned
+def get_analytics(user):
+    # Optional day range as YYYY-MM-DD; defaults to the last 12 months
+    today = datetime.now().date()
+    try:
+        end = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if 'to' in request.args else today
+        if 'from' in request.args:
+            start = datetime.strptime(request.args['from'], '%Y-%m-%d').date()
+        else:
+            months_back = end.year * 12 + end.month - 1 - 11
+            start = end.replace(year=months_back // 12, month=months_back % 12 + 1, day=1)
+    except ValueError:
+        return jsonify({'message': 'Invalid date format. Use YYYY-MM-DD'}), 400
+    if start > end:
+        return jsonify({'message': 'from must not be after to'}), 400
+    if (end - start).days >= current_app.config['ANALYTICS_MAX_DAYS']:
+        return jsonify({'message': f"Range is limited to {current_app.config['ANALYTICS_MAX_DAYS']} days"}), 400
+
+    try:
+        return jsonify(analytics.compute(user.id, start, end))
+    except Exception as e:
+        current_app.logger.error('Error computing analytics: %s', e, exc_info=True)
+        return jsonify({'message': 'Error computing analytics', 'error': str(e)}), 500
+
+@api.route('/api/sync', methods=['GET'])
+@token_required
+def sync(user):
+    # Delta sync for offline clients. The token is "<user version>.<global
+    # version>.<issued at>"; without one the client gets a full snapshot.
+    since = global_since = None
+    now = int(time.time())
+    token = request.args.get('since')
+    if token:
+        try:
+            parts = [int(part) for part in token.split('.')]
+        except ValueError:
+            return jsonify({'message': 'Invalid sync token'}), 400
+        if len(parts) not in (2, 3):
+            return jsonify({'message': 'Invalid sync token'}), 400
+        # Tombstones older than the retention window are gone, so older
+        # tokens (and two-part tokens, which carry no time) resync fully
+        if len(parts) == 3 and parts[2] > now - Tombstone.RETENTION.total_seconds():
+            since, global_since = parts[:2]
+
+    try:
+        # Read the versions before the changes. They only cover writes that
+        # have finished, so a write racing with this sync is returned again
+        # next time rather than skipped.
+        user_version, global_version, _ = DataVersion.get(user.id)
+        expenses = Expense.get_changes(user.id, since)
+        salaries = Salary.get_changes(user.id, since)
+        categories = Category.get_changes(user.id, since, global_since)
+        deleted = Tombstone.get_since(user.id, since) if since is not None else {}
+
+        return jsonify({
+            'expenses': expenses,
+            'salaries': salaries,
+            'categories': [category_to_dict(cat) for cat in categories],
+            'deleted': {
+                'expenses': deleted.get('expenses', []),
+                'salaries': deleted.get('salaries', []),
+                'categories': deleted.get('categories', [])
+            },
+            'full': since is None,
+            'token': f"{user_version}.{global_version}.{now}"
+        })
+    except Exception as e:
+        current_app.logger.error('Error syncing data: %s', e, exc_info=True)
+        return jsonify({'message': 'Error syncing data', 'error': str(e)}), 500
+
+# Read-only endpoints that may be combined in one /api/batch call
+BATCH_ENDPOINTS = {
+    'api.get_dashboard',
+    'api.get_salary_visualization',
+    'api.get_categories',
+    'api.get_analytics',
+    'api.list_expenses',
+    'api.search_expenses',
+    'api.suggest_terms',
+    'api.sync',
+}
+
+# (pid, executor); a pool inherited across fork has no threads
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def get_batch_pool():
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None or _batch_pool[0] != os.getpid():
+            _batch_pool = (os.getpid(), ThreadPoolExecutor(
+                max_workers=current_app.config['BATCH_WORKERS'], thread_name_prefix='batch'
+            ))
+        return _batch_pool[1]
+
+def run_batch_item(app, user, path, headers):
+    # Dispatch one sub-request through the full request pipeline, as `user`
+    with app.test_request_context(path, method='GET', headers=headers, environ_base={BATCH_USER_KEY: user}):
+        response = app.full_dispatch_request()
+        body = response.get_data().strip()
+        return response.status_code, response.headers.get('ETag'), body
+
+@api.route('/api/batch', methods=['POST'])
+@token_required
+def batch(user):
+    # {"requests": [{"id": ..., "path": "/api/dashboard", "etag": ...}, ...]}
+    # runs the GET sub-requests concurrently and returns their results in
+    # order. The caller is authenticated once for all of them.
+    data = request.get_json(silent=True) or {}
+    items = data.get('requests')
+    max_requests = current_app.config['BATCH_MAX_REQUESTS']
+    if not isinstance(items, list) or not items:
+        return jsonify({'message': 'requests must be a non-empty list'}), 400
+    if len(items) > max_requests:
+        return jsonify({'message': f'At most {max_requests} requests per batch'}), 400
+
+    app = current_app._get_current_object()
+    adapter = app.url_map.bind('localhost')
+    pool = get_batch_pool()
+    futures = []
+    for item in items:
+        path = item.get('path') if isinstance(item, dict) else None
+        method = (item.get('method') or 'GET').upper() if isinstance(item, dict) else None
+        try:
+            endpoint, _ = adapter.match(path.split('?', 1)[0], method=method)
+        except Exception:
+            endpoint = None
+        if method != 'GET' or endpoint not in BATCH_ENDPOINTS:
+            futures.append(None)
+            continue
+        headers = {'If-None-Match': item['etag']} if item.get('etag') else {}
+        futures.append(pool.submit(run_batch_item, app, user, path, headers))
+
+    # Sub-responses are already serialized JSON; splice them in as-is
+    parts = []
+    for item, future in zip(items, futures):
+        item_id = item.get('id') if isinstance(item, dict) else None
+        if future is None:
+            status, etag, body = 400, None, serialization.dumps({'message': 'Request not allowed in a batch'})
+        else:
+            try:
+                status, etag, body = future.result()
+            except Exception as e:
+                current_app.logger.error('Error in batch item %s: %s', item_id, e, exc_info=True)
+                status, etag, body = 500, None, serialization.dumps({'message': 'Internal server error'})
+        head = serialization.dumps({'id': item_id, 'status': status, 'etag': etag})
+        parts.append(head[:-1] + b',"body":' + (body or b'null') + b'}')
+    return current_app.response_class(
+        b'{"responses":[' + b','.join(parts) + b']}\n', mimetype='application/json'
+    )
+
+@api.route('/api/health')
 def health_check():
     try:
         db.command('ping')
         db_status = "healthy"
     except Exception as e:
         db_status = f"unhealthy: {str(e)}"
+    response_cache = current_app.extensions.get('response_cache')
     
     health_data = {
         "status": "up",
         "timestamp": datetime.now().isoformat(),
         "database": db_status,
+        "user_cache": user_cache.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
         "version": "1.0.0"
     }
     
     return jsonify(health_data)
 
-@app.route('/api/categories', methods=['GET'])
+@api.route('/api/metrics')
+def get_metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        return jsonify({'message': 'Resource not found'}), 404
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'message': 'Unauthorized access'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/categories', methods=['GET'])
 @token_required
+@versioned
 def get_categories(user):
     try:
         # Ensure user_id is ObjectId
         user_obj_id = ObjectId(user.id) if not isinstance(user.id, ObjectId) else user.id
-        categories = Category.get_by_user(user_obj_id)
-        app.logger.info(f"Fetched categories for user {user.id}: {categories}")
-        return jsonify([{
-            'id': str(cat['_id']), 
-            'name': cat['name'],
-            'is_global': cat.get('is_global', False)
-        } for cat in categories])
+        categories = Category.get_by_user(user_obj_id, g.data_version[1])
+        return jsonify([category_to_dict(cat) for cat in categories])
     except Exception as e:
-        app.logger.error(f"Error fetching categories: {e}")
+        current_app.logger.error('Error fetching categories: %s', e)
         return jsonify({'message': 'Error fetching categories', 'error': str(e)}), 500
 
-@app.route('/api/categories', methods=['POST'])
+@api.route('/api/categories', methods=['POST'])
 @token_required
 def add_category(user):
     data = request.get_json()
@@ -432,28 +916,115 @@ def add_category(user):
     cat_id = Category.create(name, user.id, is_global=False)
     return jsonify({'id': cat_id, 'name': name, 'is_global': False}), 201
 
-@app.route('/api/categories/<id>', methods=['DELETE'])
+@api.route('/api/categories/<id>', methods=['DELETE'])
 @token_required
 def delete_category(user, id):
     try:
-        cat = db.categories.find_one({'_id': ObjectId(id)})
+        if Category.delete(ObjectId(id), user.id):
+            return jsonify({'message': 'Category deleted successfully'})
+
+        # Nothing matched; look the category up only to pick the error
+        cat = db.categories.find_one({'_id': ObjectId(id)}, {'is_global': 1})
         if not cat:
             return jsonify({'message': 'Category not found'}), 404
         if cat.get('is_global', False):
             return jsonify({'message': 'Cannot delete global category'}), 403
-        
-        # Convert both IDs to string for comparison
-        category_user_id = str(cat.get('user_id'))
-        current_user_id = str(user.id)
-        
-        if category_user_id != current_user_id:
-            return jsonify({'message': 'You can only delete your own categories'}), 403
-            
-        Category.delete(id, user.id)
-        return jsonify({'message': 'Category deleted successfully'})
+        return jsonify({'message': 'You can only delete your own categories'}), 403
     except Exception as e:
-        app.logger.error(f"Error deleting category: {e}")
+        current_app.logger.error('Error deleting category: %s', e)
         return jsonify({'message': 'Error deleting category', 'error': str(e)}), 500
 
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.update(load_config(config))
+    if app.config['PROXY_FIX_X_FOR']:
+        # request.remote_addr is the proxy's address otherwise, so every
+        # client would share one per-IP rate limit bucket
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+    log_handler = logs.init_app(app)
+    atexit.register(log_handler.stop)
+
+    CORS(app, 
+         supports_credentials=True,
+         resources={r"/api/*": {
+             "origins": "*",  # Allow all origins
+             "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"],
+             "expose_headers": ["Content-Type", "Authorization"],
+             "max_age": 3600
+         }}
+    )
+
+    # Only records settings; each worker connects on first use after fork
+    models.configure(app.config['MONGODB_URI'], app.config['MONGODB_DATABASE'],
+                     **mongo_client_options(app.config))
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
+    user_cache.ttl = app.config['USER_CACHE_TTL']
+
+    login_manager.init_app(app)
+    serialization.init_app(app)
+    metrics.init_app(app, server_timing=app.config['SERVER_TIMING'], directory=app.config['METRICS_DIR'])
+    metrics.registry.callback('user_cache_hits_total', 'Authenticated user cache hits',
+                              lambda: user_cache.stats()['hits'], kind='counter')
+    metrics.registry.callback('user_cache_misses_total', 'Authenticated user cache misses',
+                              lambda: user_cache.stats()['misses'], kind='counter')
+    metrics.registry.callback('user_cache_size', 'Authenticated user cache entries',
+                              lambda: user_cache.stats()['size'])
+
+    response_cache = create_cache(
+        app.config['RESPONSE_CACHE_BACKEND'],
+        path=app.config['RESPONSE_CACHE_PATH'],
+        maxsize=app.config['RESPONSE_CACHE_SIZE'],
+        ttl=app.config['RESPONSE_CACHE_TTL']
+    )
+    for key in ('hits', 'misses', 'evictions', 'size'):
+        name = f'response_cache_{key}' + ('' if key == 'size' else '_total')
+        if response_cache is None:
+            metrics.registry.remove(name)
+            continue
+        metrics.registry.callback(
+            name,
+            f'Response cache {key}',
+            lambda key=key: response_cache.stats()[key],
+            kind='gauge' if key == 'size' else 'counter'
+        )
+    if response_cache is not None:
+        app.extensions['response_cache'] = response_cache
+
+    if app.config['RATE_LIMIT_ENABLED']:
+        app.extensions['rate_limiter'] = ratelimit.create_limiter(app.config)
+
+    # The write-behind queue is process-wide state in models; flush the one a
+    # previous app installed and replace or remove it
+    models.flush_write_behind()
+    models.enable_write_behind(None)
+    if app.config['WRITE_BEHIND_ENABLED']:
+        write_queue = WriteBehindQueue(
+            models.write_pending,
+            max_size=app.config['WRITE_BEHIND_MAX_QUEUE'],
+            batch_size=app.config['WRITE_BEHIND_BATCH_SIZE'],
+            flush_interval=app.config['WRITE_BEHIND_FLUSH_INTERVAL_MS'] / 1000,
+            put_timeout=app.config['WRITE_BEHIND_PUT_TIMEOUT_MS'] / 1000,
+            key_fn=models.write_behind_key
+        )
+        models.enable_write_behind(write_queue, write_behind_concern(app.config))
+        atexit.register(write_queue.close)
+    for key in ('queued', 'flushed', 'failed', 'rejected'):
+        name = f'write_behind_{key}' + ('' if key == 'queued' else '_total')
+        if not app.config['WRITE_BEHIND_ENABLED']:
+            metrics.registry.remove(name)
+            continue
+        metrics.registry.callback(
+            name,
+            f'Write-behind queue {key} items',
+            lambda key=key: write_queue.stats()[key],
+            kind='gauge' if key == 'queued' else 'counter'
+        )
+
+    app.register_blueprint(api)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
@@ -0,0 +1,2 @@
+# Load-test and micro-benchmark suite for the Money Tracker API.
+# Run with `python -m benchmarks --help`.
@@ -0,0 +1,83 @@
+import argparse
+import json
+import platform
+import sys
+from datetime import datetime
+from pymongo import monitoring
+from benchmarks import harness
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Benchmark every /api route against seeded data')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='Comma separated expense counts per seeded user')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per route and size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongomock', action='store_true', help='Run against mongomock instead of a MongoDB server')
+    parser.add_argument('--uri', help='MongoDB server to seed and benchmark; required unless --mongomock')
+    parser.add_argument('--database', default=harness.DEFAULT_DATABASE,
+                        help='Database to seed; dropped afterwards if the run created it')
+    parser.add_argument('--allow-remote', action='store_true',
+                        help='Allow a --uri that points at a host other than this machine')
+    parser.add_argument('--keep', action='store_true', help='Keep the seeded database')
+    parser.add_argument('--url', help='Drive a running server (e.g. gunicorn) instead of the test client')
+    parser.add_argument('--save', metavar='NAME', help='Store results as benchmarks/baselines/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='Compare results with a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed relative p95 increase before a route counts as regressed')
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    args = parser.parse_args(argv)
+    if not args.mongomock:
+        # Seeding writes 100k+ expenses, so never fall back to MONGODB_URI
+        if not args.uri:
+            parser.error('--uri is required unless --mongomock is given')
+        if not args.allow_remote and not harness.is_local_uri(args.uri):
+            parser.error('--uri is not a local server; pass --allow-remote to use it anyway')
+    harness.use_database(args.uri, args.database)
+
+    counter = None
+    if args.mongomock:
+        harness.use_mongomock()
+    else:
+        # Must happen before models.py creates the MongoClient
+        counter = harness.CommandCounter()
+        monitoring.register(counter)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    existed = harness.database_exists(args.database)
+    try:
+        results = harness.run(sizes, args.requests, seed=args.seed, base_url=args.url,
+                              counter=counter)
+    finally:
+        if existed:
+            print(f"{args.database} already existed; the seeded data was left in it", file=sys.stderr)
+        elif not args.keep:
+            harness.drop_database(args.database)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print('\n'.join(harness.format_results(results)))
+
+    if args.save:
+        meta = {
+            'created_at': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'backend': 'mongomock' if args.mongomock else 'mongodb',
+            'target': args.url or 'test-client',
+            'sizes': sizes,
+            'requests': args.requests,
+            'seed': args.seed
+        }
+        print(f"saved {harness.save_baseline(args.save, results, meta)}")
+
+    if args.compare:
+        lines, regressed = harness.compare(harness.load_baseline(args.compare), results, args.threshold)
+        print('\n'.join(lines))
+        return 1 if regressed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+import random
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+
+CATEGORIES = ['Food', 'Rent', 'Transport', 'Shopping', 'Utilities', 'Health',
+              'Entertainment', 'Travel', 'Education', 'Gifts']
+DESCRIPTIONS = ['grocery store', 'monthly rent', 'metro card', 'online order',
+                'electricity bill', 'pharmacy', 'cinema tickets', 'flight',
+                'course fee', 'birthday present', 'coffee', 'refund']
+PASSWORD = 'benchmark-password'
+
+
+def seed_user(size, seed=0, years=3, batch_size=1000):
+    # Create a user with `size` expenses spread over the last `years` years,
+    # one salary per month and a few custom categories, all written through
+    # the models API. Returns the created User.
+    from models import User, Expense, Salary, Category
+
+    rng = random.Random(f"{seed}-{size}")
+    tag = f"{size}-{seed}-{rng.randrange(10 ** 9)}"
+    user = User.create(f"bench-{tag}@example.com", f"bench-{tag}",
+                       generate_password_hash(PASSWORD))
+
+    now = datetime.now()
+    span = timedelta(days=365 * years).total_seconds()
+    batch = []
+    for _ in range(size):
+        batch.append({
+            'amount': round(rng.uniform(1, 500), 2),
+            'category': rng.choice(CATEGORIES),
+            'description': rng.choice(DESCRIPTIONS),
+            'date': now - timedelta(seconds=rng.uniform(0, span)),
+            'transaction_type': 'CR' if rng.random() < 0.1 else 'DR'
+        })
+        if len(batch) >= batch_size:
+            Expense.create_many(user.id, batch)
+            batch = []
+    if batch:
+        Expense.create_many(user.id, batch)
+
+    for months_back in range(years * 12):
+        date = datetime(now.year, now.month, 1) - timedelta(days=30 * months_back)
+        Salary.create(round(rng.uniform(3000, 6000), 2), date, user.id)
+
+    for name in rng.sample(CATEGORIES, 3):
+        Category.create(f"{name} (custom)", user.id)
+
+    return user
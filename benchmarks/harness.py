@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+import time
+from urllib import request as urllib_request
+from pymongo import monitoring, uri_parser
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+DEFAULT_DATABASE = 'money_tracker_benchmark'
+LOCAL_HOSTS = {'localhost', '127.0.0.1', '::1'}
+
+# (name, method, path, json body) for every /api route that does not destroy data
+ROUTES = [
+    ('health', 'GET', '/api/health', None),
+    ('login', 'POST', '/api/login', None),
+    ('dashboard', 'GET', '/api/dashboard', None),
+    ('expenses_page', 'GET', '/api/expenses?limit=50', None),
+    ('add_expense', 'POST', '/api/expenses',
+     {'amount': 12.5, 'category': 'Food', 'description': 'benchmark', 'date': '2024-01-15', 'transaction_type': 'DR'}),
+    ('salary_visualization', 'GET', '/api/salary/visualization', None),
+    ('categories', 'GET', '/api/categories', None),
+    ('sync', 'GET', '/api/sync', None),
+    ('export_ndjson', 'GET', '/api/expenses/export?format=ndjson', None),
+    # What the mobile client loads on launch, in one round trip
+    ('batch_launch', 'POST', '/api/batch',
+     {'requests': [{'id': 'dashboard', 'path': '/api/dashboard'},
+                   {'id': 'salary', 'path': '/api/salary/visualization'},
+                   {'id': 'categories', 'path': '/api/categories'}]}),
+]
+
+
+class CommandCounter(monitoring.CommandListener):
+    # Counts MongoDB commands; must be registered before the client exists
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        with self._lock:
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def is_local_uri(uri):
+    # mongodb+srv URIs always name a DNS seedlist, i.e. a hosted cluster
+    if uri.startswith('mongodb+srv://'):
+        return False
+    hosts = [host for host, _ in uri_parser.parse_uri(uri)['nodelist']]
+    return all(host in LOCAL_HOSTS or host.startswith('/') for host in hosts)
+
+
+def use_database(uri, database):
+    # Point the app at the benchmark database; must run before app.py is
+    # imported, since importing it creates the app from the environment
+    if uri:
+        os.environ['MONGODB_URI'] = uri
+    os.environ['MONGODB_DATABASE'] = database
+
+
+def database_exists(database):
+    from models import get_client
+    return database in get_client().list_database_names()
+
+
+def drop_database(database):
+    from models import get_client
+    get_client().drop_database(database)
+
+
+def use_mongomock():
+    # Swap in mongomock before models.py creates its client
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, ops):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mongo_ops_per_request': ops / len(latencies) if ops is not None and latencies else None
+    }
+
+
+class ClientTarget:
+    # Drives the app in-process through the Flask test client
+    def __init__(self):
+        from app import app
+        self.client = app.test_client()
+
+    def send(self, method, path, headers, body):
+        response = self.client.open(path, method=method, headers=headers, json=body)
+        response.get_data()
+        return response.status_code
+
+
+class HttpTarget:
+    # Drives a running server, e.g. `gunicorn app:app`
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, method, path, headers, body):
+        data = json.dumps(body).encode() if body is not None else None
+        headers = dict(headers, **({'Content-Type': 'application/json'} if data else {}))
+        req = urllib_request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib_request.urlopen(req) as response:
+                response.read()
+                return response.status
+        except urllib_request.HTTPError as e:
+            return e.code
+
+
+def bench_route(target, counter, method, path, headers, body, requests):
+    latencies = []
+    ops_before = counter.count if counter else None
+    started = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        status = target.send(method, path, headers, body)
+        latencies.append(time.perf_counter() - t0)
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} returned {status}")
+    elapsed = time.perf_counter() - started
+    ops = counter.count - ops_before if counter else None
+    return summarize(latencies, elapsed, ops)
+
+
+def bench_function(fn, counter, requests):
+    latencies = []
+    ops_before = counter.count if counter else None
+    started = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    ops = counter.count - ops_before if counter else None
+    return summarize(latencies, elapsed, ops)
+
+
+def run(sizes, requests, seed=0, base_url=None, counter=None):
+    # Returns {size: {name: stats}}. Data is always seeded through models.py,
+    # so with base_url the server must share the same database.
+    from flask import Flask
+    from app import app, generate_token, token_required
+    from models import Category, User, db
+    from benchmarks.datagen import seed_user, PASSWORD
+
+    if not db.categories.find_one({'is_global': True}):
+        for name in ['Food', 'Rent', 'Transport', 'Shopping', 'Utilities']:
+            Category.create(name, is_global=True)
+
+    target = HttpTarget(base_url) if base_url else ClientTarget()
+    # Mongo ops can only be attributed when the app runs in this process
+    route_counter = None if base_url else counter
+
+    # A bare app used to measure token_required on its own
+    auth_app = Flask('auth-bench')
+    auth_app.config.update(JWT_SECRET_KEY=app.config['JWT_SECRET_KEY'],
+                           JWT_ACCESS_TOKEN_EXPIRES=app.config['JWT_ACCESS_TOKEN_EXPIRES'])
+
+    @auth_app.route('/auth')
+    @token_required
+    def auth_only(user):
+        return 'ok'
+
+    results = {}
+    for size in sizes:
+        user = seed_user(size, seed=seed)
+        with app.app_context():
+            token = generate_token(user)
+        headers = {'Authorization': f'Bearer {token}'}
+        size_results = {}
+        for name, method, path, body in ROUTES:
+            if name == 'login':
+                body = {'email': user.email, 'password': PASSWORD}
+            size_results[name] = bench_route(target, route_counter, method, path, headers, body, requests)
+
+        auth_client = auth_app.test_client()
+        size_results['token_required'] = bench_function(
+            lambda: auth_client.get('/auth', headers=headers), counter, requests)
+        size_results['Category.get_by_user'] = bench_function(
+            lambda: Category.get_by_user(user.id), counter, requests)
+        size_results['User.get'] = bench_function(lambda: User.get(user.id), counter, requests)
+        results[str(size)] = size_results
+    return results
+
+
+def save_baseline(name, results, meta):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, f"{name}.json")
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+    return path
+
+
+def load_baseline(name):
+    with open(os.path.join(BASELINE_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+def compare(baseline, results, threshold=0.2):
+    # Returns (lines, regressed) comparing p95 latency and Mongo ops
+    lines = []
+    regressed = False
+    for size, size_results in results.items():
+        for name, stats in size_results.items():
+            old = baseline['results'].get(size, {}).get(name)
+            if not old:
+                lines.append(f"{size:>7} {name:<24} new")
+                continue
+            change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+            flag = ''
+            if change > threshold:
+                flag = 'REGRESSION'
+                regressed = True
+            ops = stats['mongo_ops_per_request']
+            old_ops = old['mongo_ops_per_request']
+            if ops is not None and old_ops is not None and ops > old_ops:
+                flag = 'REGRESSION'
+                regressed = True
+            lines.append(f"{size:>7} {name:<24} p95 {old['p95_ms']:8.2f} -> {stats['p95_ms']:8.2f} ms "
+                         f"({change:+.0%}) ops {old_ops} -> {ops} {flag}".rstrip())
+    return lines, regressed
+
+
+def format_results(results):
+    lines = [f"{'size':>7} {'benchmark':<24} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>9} {'ops/req':>8}"]
+    for size, size_results in results.items():
+        for name, stats in size_results.items():
+            ops = stats['mongo_ops_per_request']
+            lines.append(f"{size:>7} {name:<24} {stats['p50_ms']:8.2f} {stats['p95_ms']:8.2f} "
+                         f"{stats['p99_ms']:8.2f} {stats['throughput_rps']:9.1f} "
+                         f"{'-' if ops is None else f'{ops:.1f}':>8}")
+    return lines
@@ -0,0 +1,188 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheBackend:
+    # Interface shared by the cache implementations
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def invalidate(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+
+class TTLCache(CacheBackend):
+    # Bounded, thread-safe in-memory LRU cache whose entries expire `ttl`
+    # seconds after they were stored. Private to one process.
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+class SQLiteConnections:
+    # Autocommit connections to one SQLite file in WAL mode, one per thread
+    # and process; sqlite3 connections must not cross either boundary
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class SQLiteCache(CacheBackend):
+    # LRU cache stored in a local SQLite file so every worker process on the
+    # host shares it. Keys are strings and values bytes. Hit/miss counters
+    # are per process; size is shared.
+    def __init__(self, path, maxsize=10000, ttl=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._connections = SQLiteConnections(path)
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        with self._connections.get() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                'expires_at REAL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)')
+
+    def _count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        now = time.time()
+        conn = self._connections.get()
+        row = conn.execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, now)
+        ).fetchone()
+        if row is None:
+            self._count(False)
+            return default
+        conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+        self._count(True)
+        return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        expires_at = now + self.ttl if self.ttl else None
+        conn = self._connections.get()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(value), expires_at, now)
+        )
+        # Drop expired rows first, then the least recently used ones
+        conn.execute('DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        evicted = conn.execute(
+            'DELETE FROM cache WHERE key IN ('
+            'SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.maxsize,)
+        ).rowcount
+        if evicted > 0:
+            with self._stats_lock:
+                self.evictions += evicted
+
+    def invalidate(self, key):
+        self._connections.get().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connections.get().execute('DELETE FROM cache')
+
+    def stats(self):
+        size = self._connections.get().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': size,
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+def create_cache(backend, path=None, maxsize=1024, ttl=300):
+    # Build a cache from config values; 'none' disables caching
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+    if backend == 'sqlite':
+        return SQLiteCache(path, maxsize=maxsize, ttl=ttl)
+    raise ValueError(f'Unknown cache backend {backend!r}')
@@ -0,0 +1,159 @@
+import os
+import tempfile
+from datetime import timedelta
+from dotenv import load_dotenv
+from pymongo.write_concern import WriteConcern
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def parse_float_map(value):
+    # "api.login=10,/api/expenses=0.5" -> {name: float}; used for the
+    # per-endpoint settings RATE_LIMIT_COSTS and LOG_SAMPLE_RATES
+    mapping = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, number = item.rpartition('=')
+        mapping[name] = float(number)
+    return mapping
+
+
+def load_config(overrides=None):
+    # Build the application config from the environment (and .env), with
+    # `overrides` taking precedence
+    load_dotenv()
+    config = {
+        'SECRET_KEY': os.environ.get('SECRET_KEY'),
+        'JWT_SECRET_KEY': os.environ.get('JWT_SECRET_KEY'),
+        'JWT_ACCESS_TOKEN_EXPIRES': timedelta(hours=1),
+        'JWT_REFRESH_TOKEN_EXPIRES': timedelta(days=_env_int('REFRESH_TOKEN_DAYS', 30)),
+
+        # MongoDB client, created lazily once per worker process
+        'MONGODB_URI': os.environ.get('MONGODB_URI'),
+        'MONGODB_DATABASE': os.environ.get('MONGODB_DATABASE', 'money_tracker'),
+        'MONGO_MAX_POOL_SIZE': _env_int('MONGO_MAX_POOL_SIZE', 50),
+        'MONGO_MIN_POOL_SIZE': _env_int('MONGO_MIN_POOL_SIZE', 0),
+        'MONGO_MAX_IDLE_TIME_MS': _env_int('MONGO_MAX_IDLE_TIME_MS', 60000),
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS': _env_int('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000),
+        'MONGO_CONNECT_TIMEOUT_MS': _env_int('MONGO_CONNECT_TIMEOUT_MS', 5000),
+        'MONGO_SOCKET_TIMEOUT_MS': _env_int('MONGO_SOCKET_TIMEOUT_MS', 30000),
+        # Comma separated, e.g. "zstd,snappy,zlib"; zstd and snappy need extra packages
+        'MONGO_COMPRESSORS': os.environ.get('MONGO_COMPRESSORS', ''),
+        'MONGO_READ_PREFERENCE': os.environ.get('MONGO_READ_PREFERENCE', 'primary'),
+
+        'USER_CACHE_SIZE': _env_int('USER_CACHE_SIZE', 1024),
+        'USER_CACHE_TTL': float(os.environ.get('USER_CACHE_TTL', 300)),
+
+        'EXPENSES_PAGE_SIZE': 50,
+        'EXPENSES_MAX_PAGE_SIZE': 200,
+        'BULK_BATCH_SIZE': 500,
+        'BULK_MAX_ROWS': 10000,
+        'EXPORT_BATCH_SIZE': 1000,
+        'ANALYTICS_MAX_DAYS': 3660,
+        'SUGGEST_LIMIT': 10,
+        # /api/batch: sub-requests per call and threads per worker process
+        'BATCH_MAX_REQUESTS': _env_int('BATCH_MAX_REQUESTS', 10),
+        'BATCH_WORKERS': _env_int('BATCH_WORKERS', 4),
+
+        # Token-bucket rate limiting (see ratelimit.py), per user for
+        # authenticated endpoints and per client IP for login/register/refresh
+        'RATE_LIMIT_ENABLED': _env_flag('RATE_LIMIT_ENABLED'),
+        # 'memory' (per worker) or 'sqlite' (shared by the workers on a host)
+        'RATE_LIMIT_STORE': os.environ.get('RATE_LIMIT_STORE', 'memory'),
+        'RATE_LIMIT_PATH': os.environ.get(
+            'RATE_LIMIT_PATH', os.path.join(tempfile.gettempdir(), 'moneytracker-ratelimit.sqlite3')),
+        # Tokens per second and bucket size
+        'RATE_LIMIT_USER_RATE': float(os.environ.get('RATE_LIMIT_USER_RATE', 5)),
+        'RATE_LIMIT_USER_BURST': float(os.environ.get('RATE_LIMIT_USER_BURST', 60)),
+        'RATE_LIMIT_IP_RATE': float(os.environ.get('RATE_LIMIT_IP_RATE', 0.5)),
+        'RATE_LIMIT_IP_BURST': float(os.environ.get('RATE_LIMIT_IP_BURST', 20)),
+        # Tokens per request by endpoint, 1 when not listed; RATE_LIMIT_COSTS
+        # overrides them as "api.get_dashboard=5,api.login=10"
+        'RATE_LIMIT_DEFAULT_COSTS': {
+            'api.login': 5,
+            'api.register': 5,
+            'api.get_dashboard': 3,
+            'api.get_salary_visualization': 3,
+            'api.get_analytics': 10,
+            'api.export_expenses': 10,
+            'api.bulk_add_expenses': 10,
+            'api.search_expenses': 2,
+        },
+        'RATE_LIMIT_COSTS': os.environ.get('RATE_LIMIT_COSTS', ''),
+        # Reverse proxies in front of the app (1 on Render) whose
+        # X-Forwarded-For entries are trusted for the client IP. Leave at 0
+        # when clients connect directly, or they can pick their own IP.
+        'PROXY_FIX_X_FOR': _env_int('PROXY_FIX_X_FOR', 0),
+        'SERVER_TIMING': _env_flag('SERVER_TIMING'),
+        # /api/metrics is off unless enabled; with a token, scrapers must send
+        # "Authorization: Bearer <token>"
+        'METRICS_ENABLED': _env_flag('METRICS_ENABLED'),
+        'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+        # Directory where gunicorn workers share their metrics; without it
+        # each scrape only sees the worker that served it
+        'METRICS_DIR': os.environ.get('METRICS_DIR'),
+
+        # Logging (see logs.py): records are written by a background thread
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'INFO').upper(),
+        # 'json' for one JSON object per line, or 'text'
+        'LOG_FORMAT': os.environ.get('LOG_FORMAT', 'json'),
+        'LOG_QUEUE_SIZE': _env_int('LOG_QUEUE_SIZE', 10000),
+        # Fraction of sub-WARNING records kept, overridable per route as
+        # "/api/dashboard=0.1,/api/expenses=0.5"
+        'LOG_SAMPLE_RATE': float(os.environ.get('LOG_SAMPLE_RATE', 1.0)),
+        'LOG_SAMPLE_RATES': os.environ.get('LOG_SAMPLE_RATES', ''),
+        'LOG_PAYLOAD_MAX_BYTES': _env_int('LOG_PAYLOAD_MAX_BYTES', 2048),
+        # 'auto' uses orjson when it is installed, else the stdlib json module
+        'JSON_BACKEND': os.environ.get('JSON_BACKEND', 'auto'),
+
+        # Batch expense/salary inserts on a background thread (see writebehind.py)
+        'WRITE_BEHIND_ENABLED': _env_flag('WRITE_BEHIND_ENABLED'),
+        'WRITE_BEHIND_MAX_QUEUE': _env_int('WRITE_BEHIND_MAX_QUEUE', 10000),
+        'WRITE_BEHIND_BATCH_SIZE': _env_int('WRITE_BEHIND_BATCH_SIZE', 500),
+        'WRITE_BEHIND_FLUSH_INTERVAL_MS': _env_int('WRITE_BEHIND_FLUSH_INTERVAL_MS', 50),
+        'WRITE_BEHIND_PUT_TIMEOUT_MS': _env_int('WRITE_BEHIND_PUT_TIMEOUT_MS', 100),
+        # Write concern for batched inserts: a number of nodes or "majority"
+        'WRITE_BEHIND_W': os.environ.get('WRITE_BEHIND_W', '1'),
+        'WRITE_BEHIND_JOURNAL': _env_flag('WRITE_BEHIND_JOURNAL'),
+
+        # Serialized responses of @versioned endpoints, keyed by path, user and
+        # data version: 'none', 'memory' (per worker) or 'sqlite' (shared by
+        # all workers on the host through RESPONSE_CACHE_PATH)
+        'RESPONSE_CACHE_BACKEND': os.environ.get('RESPONSE_CACHE_BACKEND', 'none'),
+        'RESPONSE_CACHE_PATH': os.environ.get(
+            'RESPONSE_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'moneytracker-responses.sqlite3')),
+        'RESPONSE_CACHE_SIZE': _env_int('RESPONSE_CACHE_SIZE', 10000),
+        'RESPONSE_CACHE_TTL': float(os.environ.get('RESPONSE_CACHE_TTL', 300)),
+    }
+    config.update(overrides or {})
+    return config
+
+
+def write_behind_concern(config):
+    w = config['WRITE_BEHIND_W']
+    return WriteConcern(w=int(w) if str(w).isdigit() else w, j=config['WRITE_BEHIND_JOURNAL'] or None)
+
+
+def mongo_client_options(config):
+    # Keyword arguments for MongoClient derived from the config
+    options = {
+        'maxPoolSize': config['MONGO_MAX_POOL_SIZE'],
+        'minPoolSize': config['MONGO_MIN_POOL_SIZE'],
+        'maxIdleTimeMS': config['MONGO_MAX_IDLE_TIME_MS'],
+        'serverSelectionTimeoutMS': config['MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+        'connectTimeoutMS': config['MONGO_CONNECT_TIMEOUT_MS'],
+        'socketTimeoutMS': config['MONGO_SOCKET_TIMEOUT_MS'],
+        'readPreference': config['MONGO_READ_PREFERENCE'],
+    }
+    if config['MONGO_COMPRESSORS']:
+        options['compressors'] = config['MONGO_COMPRESSORS']
+    return options
@@ -0,0 +1,39 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+
+# Import the app once in the master so workers fork with the code already
+# loaded. models.py creates its MongoClient lazily, so nothing connects
+# before the fork.
+preload_app = True
+
+# Recycle workers now and then to cap memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+
+def on_starting(server):
+    # Drop metrics files left by the previous server's workers
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        import metrics
+        metrics.clear_directory(metrics_dir)
+
+
+def post_fork(server, worker):
+    # Make sure each worker gets its own client and connection pool
+    import models
+    models.reset_client()
+
+
+def worker_exit(server, worker):
+    # Flush queued write-behind inserts before the worker goes away
+    import metrics
+    import models
+    models.flush_write_behind()
+    metrics.flush()
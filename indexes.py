@@ -0,0 +1,213 @@
+import argparse
+import sys
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+from config import load_config, mongo_client_options
+from models import Tombstone, configure, db
+
+# Bump INDEX_VERSION whenever INDEXES changes so deploys know to re-run `ensure`
+INDEX_VERSION = 7
+
+INDEXES = {
+    'users': [
+        {'name': 'email_unique', 'keys': [('email', ASCENDING)], 'unique': True},
+        {'name': 'username_unique', 'keys': [('username', ASCENDING)], 'unique': True},
+    ],
+    'expenses': [
+        # Serves per-user listings, month ranges and (date, _id) keyset pagination
+        {'name': 'user_date', 'keys': [('user_id', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)]},
+        {'name': 'user_sync', 'keys': [('user_id', ASCENDING), ('sync_version', ASCENDING)]},
+        # /api/expenses/search; queries must match user_id exactly
+        {'name': 'user_text', 'keys': [('user_id', ASCENDING), ('description', TEXT), ('category', TEXT)]},
+    ],
+    'salaries': [
+        {'name': 'user_date', 'keys': [('user_id', ASCENDING), ('date', DESCENDING)]},
+        {'name': 'user_sync', 'keys': [('user_id', ASCENDING), ('sync_version', ASCENDING)]},
+    ],
+    'categories': [
+        # Covers Category.get_by_user's query for the user's own categories
+        {'name': 'user_global_name', 'keys': [('user_id', ASCENDING), ('is_global', ASCENDING),
+                                              ('name', ASCENDING), ('_id', ASCENDING)]},
+        # Global categories (cached per process) and the global branch of sync
+        {'name': 'global', 'keys': [('is_global', ASCENDING)]},
+        {'name': 'user_sync', 'keys': [('user_id', ASCENDING), ('sync_version', ASCENDING)]},
+    ],
+    'tombstones': [
+        {'name': 'user_sync', 'keys': [('user_id', ASCENDING), ('sync_version', ASCENDING)]},
+        {'name': 'deleted_ttl', 'keys': [('deleted_at', ASCENDING)],
+         'expire_after_seconds': int(Tombstone.RETENTION.total_seconds())},
+    ],
+    'refresh_tokens': [
+        # _id is the token hash; these serve family and per-user revocation
+        {'name': 'family', 'keys': [('family', ASCENDING)]},
+        {'name': 'user', 'keys': [('user_id', ASCENDING)]},
+        {'name': 'expires_ttl', 'keys': [('expires_at', ASCENDING)], 'expire_after_seconds': 0},
+    ],
+    'search_terms': [
+        # Anchored prefix regexes on term are range scans within a user (and kind)
+        {'name': 'user_kind_term_unique', 'keys': [('user_id', ASCENDING), ('kind', ASCENDING), ('term', ASCENDING)],
+         'unique': True},
+    ],
+    'monthly_rollups': [
+        {'name': 'user_month_unique', 'keys': [('user_id', ASCENDING), ('month', ASCENDING)], 'unique': True},
+    ],
+}
+
+# Representative queries used by `report` to check that the planner picks an
+# index and avoids in-memory sorts
+PROBE_QUERIES = [
+    ('users', {'email': 'probe@example.com'}, None),
+    ('users', {'username': 'probe'}, None),
+    ('expenses', {'user_id': 'probe'}, [('date', DESCENDING)]),
+    ('expenses', {'user_id': 'probe', 'date': {'$gte': datetime(2000, 1, 1)}},
+     [('date', DESCENDING), ('_id', DESCENDING)]),
+    ('expenses', {'user_id': 'probe', 'sync_version': {'$gt': 0}}, None),
+    ('salaries', {'user_id': 'probe'}, [('date', DESCENDING)]),
+    ('salaries', {'user_id': 'probe', 'sync_version': {'$gt': 0}}, None),
+    ('tombstones', {'user_id': 'probe', 'sync_version': {'$gt': 0}}, None),
+    ('expenses', {'user_id': 'probe', '$text': {'$search': 'probe'}}, None),
+    ('search_terms', {'user_id': 'probe', 'term': {'$regex': '^pro'}}, None),
+    ('search_terms', {'user_id': 'probe', 'kind': 'category', 'term': {'$regex': '^pro'}}, None),
+    ('categories', {'user_id': 'probe', 'is_global': False}, None),
+    ('categories', {'is_global': True}, None),
+]
+
+# Indexes replaced by later versions; `ensure` drops them
+DROPPED_INDEXES = {
+    'categories': ['user_global'],
+}
+
+META_ID = 'indexes'
+
+
+def ensure_indexes():
+    created = []
+    for collection, specs in INDEXES.items():
+        existing = db[collection].index_information()
+        for spec in specs:
+            if spec['name'] in existing:
+                continue
+            options = {}
+            if 'expire_after_seconds' in spec:
+                options['expireAfterSeconds'] = spec['expire_after_seconds']
+            db[collection].create_index(
+                spec['keys'],
+                name=spec['name'],
+                unique=spec.get('unique', False),
+                background=True,
+                **options
+            )
+            created.append((collection, spec['name']))
+    for collection, names in DROPPED_INDEXES.items():
+        existing = db[collection].index_information()
+        for name in names:
+            if name in existing:
+                db[collection].drop_index(name)
+    db.meta.update_one(
+        {'_id': META_ID},
+        {'$set': {'version': INDEX_VERSION, 'applied_at': datetime.utcnow()}},
+        upsert=True
+    )
+    return created
+
+
+def _stored_keys(keys):
+    # MongoDB reports the text fields of a text index as ('_fts', 'text'),
+    # ('_ftsx', 1) in their place
+    stored = []
+    for field, direction in keys:
+        if direction == TEXT:
+            if ('_fts', TEXT) not in stored:
+                stored += [('_fts', TEXT), ('_ftsx', 1)]
+        else:
+            stored.append((field, direction))
+    return stored
+
+
+def verify_indexes():
+    # Returns a list of human readable problems, empty when everything matches
+    problems = []
+    meta = db.meta.find_one({'_id': META_ID}) or {}
+    if meta.get('version') != INDEX_VERSION:
+        problems.append(f"index version is {meta.get('version')}, expected {INDEX_VERSION}")
+    for collection, specs in INDEXES.items():
+        existing = db[collection].index_information()
+        for spec in specs:
+            info = existing.get(spec['name'])
+            if not info:
+                problems.append(f"{collection}.{spec['name']} is missing")
+                continue
+            if [tuple(key) for key in info['key']] != _stored_keys(spec['keys']):
+                problems.append(f"{collection}.{spec['name']} has keys {info['key']}, expected {spec['keys']}")
+            if bool(info.get('unique')) != spec.get('unique', False):
+                problems.append(f"{collection}.{spec['name']} unique flag does not match")
+            if info.get('expireAfterSeconds') != spec.get('expire_after_seconds'):
+                problems.append(f"{collection}.{spec['name']} TTL does not match")
+    return problems
+
+
+def _plan_stages(plan):
+    yield plan['stage']
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            yield from _plan_stages(child)
+
+
+def report_indexes():
+    lines = []
+    for collection, query, sort in PROBE_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = set(_plan_stages(plan))
+        if 'COLLSCAN' in stages:
+            lines.append(f"MISSING  {collection} {query}: collection scan")
+        elif 'SORT' in stages:
+            lines.append(f"MISSING  {collection} {query}: in-memory sort")
+        else:
+            lines.append(f"OK       {collection} {query}")
+
+    for collection in INDEXES:
+        try:
+            stats = list(db[collection].aggregate([{'$indexStats': {}}]))
+        except OperationFailure as e:
+            lines.append(f"SKIPPED  {collection}: $indexStats unavailable ({e})")
+            continue
+        for stat in stats:
+            if stat['name'] != '_id_' and stat['accesses']['ops'] == 0:
+                lines.append(f"UNUSED   {collection}.{stat['name']} (no accesses since {stat['accesses']['since']})")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage MongoDB indexes for Money Tracker')
+    parser.add_argument('command', choices=['ensure', 'verify', 'report'])
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    configure(config['MONGODB_URI'], config['MONGODB_DATABASE'], **mongo_client_options(config))
+
+    if args.command == 'ensure':
+        created = ensure_indexes()
+        for collection, name in created:
+            print(f"created {collection}.{name}")
+        print(f"indexes at version {INDEX_VERSION}")
+        return 0
+
+    if args.command == 'verify':
+        problems = verify_indexes()
+        for problem in problems:
+            print(problem)
+        if not problems:
+            print(f"indexes at version {INDEX_VERSION}")
+        return 1 if problems else 0
+
+    for line in report_indexes():
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from flask import has_request_context, request
+from flask.logging import default_handler
+from config import parse_float_map
+import metrics
+import serialization
+
+# Set from LOG_PAYLOAD_MAX_BYTES in init_app
+_payload_max_bytes = 2048
+
+# Standard LogRecord attributes; anything else was passed through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+records_dropped = metrics.registry.counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+records_sampled_out = metrics.registry.counter('log_records_sampled_out_total', 'Log records skipped by per-route sampling')
+
+
+class Payload:
+    # Wraps an object passed as a logging argument so it is only serialized
+    # when a record is actually written, and never beyond the size cap:
+    #   logger.debug('Request data: %s', Payload(data))
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        try:
+            text = serialization.dumps(self.obj)
+        except TypeError:
+            text = repr(self.obj).encode()
+        if len(text) > _payload_max_bytes:
+            return f"{text[:_payload_max_bytes].decode(errors='ignore')}...({len(text)} bytes)"
+        return text.decode()
+
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per line, with request fields and `extra` values
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RouteSampler(logging.Filter):
+    # Runs on the calling thread: tags records with the request's route and
+    # method (the listener thread has no request context) and keeps only a
+    # sample of sub-WARNING records for routes with a rate below 1
+    def __init__(self, default_rate=1.0, rates=None):
+        super().__init__()
+        self.default_rate = default_rate
+        self.rates = rates or {}
+
+    def filter(self, record):
+        if not has_request_context():
+            return True
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        record.route = route
+        record.method = request.method
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(route, self.default_rate)
+        if rate < 1.0 and random.random() >= rate:
+            records_sampled_out.inc(route=route)
+            return False
+        return True
+
+
+class AsyncHandler(QueueHandler):
+    # Hands records to a QueueListener thread that formats and writes them.
+    # The listener is started lazily in the process that logs, so the
+    # handler can be installed before gunicorn forks.
+    def __init__(self, handlers, max_size=10000):
+        super().__init__(queue.Queue(max_size))
+        self.handlers = handlers
+        self.max_size = max_size
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # A queue and listener inherited from the parent are unusable
+                self.queue = queue.Queue(self.max_size)
+                self._listener = QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # The default prepare() formats the message on the calling thread;
+        # records stay in-process, so pass them through untouched
+        return record
+
+    def enqueue(self, record):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+    def stop(self):
+        if self._pid == os.getpid() and self._listener is not None:
+            self._listener.stop()
+            self._pid = None
+
+
+def init_app(app):
+    global _payload_max_bytes
+    _payload_max_bytes = app.config['LOG_PAYLOAD_MAX_BYTES']
+
+    stream = logging.StreamHandler(sys.stderr)
+    if app.config['LOG_FORMAT'] == 'json':
+        stream.setFormatter(JSONFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    handler = AsyncHandler([stream], max_size=app.config['LOG_QUEUE_SIZE'])
+    handler.addFilter(RouteSampler(app.config['LOG_SAMPLE_RATE'], parse_float_map(app.config['LOG_SAMPLE_RATES'])))
+
+    # Everything, including the app logger, goes through the root logger
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if isinstance(h, AsyncHandler)]:
+        existing.stop()
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(app.config['LOG_LEVEL'])
+    app.logger.removeHandler(default_handler)
+    app.logger.setLevel(logging.NOTSET)
+    return handler
@@ -0,0 +1,324 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import request
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def _render(name, family):
+    # Text format for one metric family as produced by a metric's snapshot()
+    lines = [f"# HELP {name} {family['help']}", f"# TYPE {name} {family['type']}"]
+    for labels, value in sorted(family['samples'], key=lambda sample: sample[0]):
+        labels = tuple(labels)
+        if family['type'] != 'histogram':
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+            continue
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(family['buckets'] + [float('inf')], counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return lines
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            samples = [(labels, value) for labels, value in self._values.items()]
+        return {'type': 'counter', 'help': self.help, 'samples': samples}
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def snapshot(self):
+        with self._lock:
+            samples = [(labels, (list(counts), total)) for labels, (counts, total) in self._values.items()]
+        return {'type': 'histogram', 'help': self.help, 'buckets': list(self.buckets), 'samples': samples}
+
+
+class CallbackMetric:
+    # Value read from a callback at scrape time, for state kept elsewhere
+    # (e.g. cache statistics). The callback returns a number or a list of
+    # (labels dict, value) pairs.
+    def __init__(self, name, help_text, callback, kind='gauge'):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self.kind = kind
+
+    def snapshot(self):
+        value = self.callback()
+        samples = value if isinstance(value, list) else [({}, value)]
+        return {
+            'type': self.kind,
+            'help': self.help,
+            'samples': [(tuple(sorted(labels.items())), sample) for labels, sample in samples]
+        }
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric, replace=False):
+        with self._lock:
+            if replace:
+                self._metrics[metric.name] = metric
+                return metric
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def callback(self, name, help_text, callback, kind='gauge'):
+        # Callbacks read objects owned by the latest app, so registering one
+        # again replaces the previous callback
+        return self._register(CallbackMetric(name, help_text, callback, kind), replace=True)
+
+    def remove(self, name):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def snapshot(self):
+        # {name: family} for every metric, in a JSON-serializable form
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render(self):
+        return render_snapshot(self.snapshot())
+
+
+def render_snapshot(snapshot):
+    lines = []
+    for name, family in snapshot.items():
+        lines.extend(_render(name, family))
+    return '\n'.join(lines) + '\n'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge_snapshots(snapshots):
+    # Sums (snapshot, alive) pairs per metric and labels. Counters and
+    # histograms of exited processes still count, so totals never go
+    # backwards when a worker is recycled; gauges only count live ones.
+    merged = {}
+    for snapshot, alive in snapshots:
+        for name, family in snapshot.items():
+            if family['type'] == 'gauge' and not alive:
+                continue
+            target = merged.setdefault(name, dict(family, samples={}))
+            for labels, value in family['samples']:
+                labels = tuple(tuple(pair) for pair in labels)
+                if family['type'] == 'histogram':
+                    counts, total = target['samples'].get(labels, ([0] * len(value[0]), 0.0))
+                    value = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+                else:
+                    value = target['samples'].get(labels, 0) + value
+                target['samples'][labels] = value
+    for family in merged.values():
+        family['samples'] = list(family['samples'].items())
+    return merged
+
+
+class MultiprocessStore:
+    # Shares metrics between gunicorn workers, which each keep their own
+    # registry: every process writes its snapshot to <directory>/<pid>.json
+    # every `interval` seconds (and on exit), and a scrape served by any
+    # worker merges all files. Other workers' values lag by up to `interval`.
+    # The directory should be emptied when the server starts (see
+    # gunicorn.conf.py), since files of exited workers are kept.
+    def __init__(self, registry, directory, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def write(self):
+        path = self._path(os.getpid())
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp, path)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def ensure_started(self):
+        # Started lazily in each worker; threads do not survive a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='metrics-writer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def collect(self):
+        self.write()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                pid = int(os.path.basename(path)[:-len('.json')])
+                with open(path) as f:
+                    snapshots.append((json.load(f), _pid_alive(pid)))
+            except (ValueError, OSError):
+                continue
+        return merge_snapshots(snapshots)
+
+    def render(self):
+        return render_snapshot(self.collect())
+
+
+def clear_directory(directory):
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+registry = Registry()
+# Set by init_app when METRICS_DIR is configured
+store = None
+
+http_requests = registry.counter('http_requests_total', 'HTTP requests by route, method and status')
+http_latency = registry.histogram('http_request_duration_seconds', 'HTTP request latency by route')
+mongo_commands = registry.counter('mongo_commands_total', 'MongoDB commands by route, command and outcome')
+mongo_latency = registry.histogram('mongo_command_duration_seconds', 'MongoDB command latency by route and command')
+
+# Route and per-request MongoDB totals for the request running on this thread.
+# pymongo publishes command events on the thread that issued the command.
+_current = threading.local()
+
+
+class CommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def _record(self, event, outcome):
+        route = getattr(_current, 'route', None) or 'none'
+        seconds = event.duration_micros / 1e6
+        mongo_commands.inc(route=route, command=event.command_name, outcome=outcome)
+        mongo_latency.observe(seconds, route=route, command=event.command_name)
+        if getattr(_current, 'route', None):
+            _current.mongo_ops += 1
+            _current.mongo_seconds += seconds
+
+    def succeeded(self, event):
+        self._record(event, 'success')
+
+    def failed(self, event):
+        self._record(event, 'failure')
+
+
+command_listener = CommandListener()
+
+
+def _before_request():
+    _current.route = request.url_rule.rule if request.url_rule else 'unmatched'
+    _current.started = time.perf_counter()
+    _current.mongo_ops = 0
+    _current.mongo_seconds = 0.0
+
+
+def render():
+    # This process's metrics, or every worker's when a store is configured
+    return store.render() if store is not None else registry.render()
+
+
+def flush():
+    if store is not None:
+        store.write()
+
+
+def init_app(app, server_timing=False, directory=None):
+    # Per-endpoint latency histograms plus optional Server-Timing headers.
+    # With `directory`, metrics are shared between worker processes.
+    global store
+    store = MultiprocessStore(registry, directory) if directory else None
+    app.before_request(_before_request)
+
+    @app.after_request
+    def record_request(response):
+        started = getattr(_current, 'started', None)
+        if started is None:
+            return response
+        if store is not None:
+            store.ensure_started()
+        route = _current.route
+        elapsed = time.perf_counter() - started
+        http_requests.inc(route=route, method=request.method, status=response.status_code)
+        http_latency.observe(elapsed, route=route)
+        if server_timing:
+            response.headers['Server-Timing'] = (
+                f'app;dur={elapsed * 1000:.1f}, '
+                f'db;dur={_current.mongo_seconds * 1000:.1f};desc="{_current.mongo_ops} ops"'
+            )
+        return response
+
+    @app.teardown_request
+    def clear_request(exc):
+        _current.route = None
+        _current.started = None
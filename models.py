@@ -1,29 +1,234 @@
 from flask_login import UserMixin
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError
 from bson import ObjectId
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import logging
 import os
-from dotenv import load_dotenv
+import re
+import secrets
+import threading
+from cache import TTLCache
+import metrics
 
-# Load environment variables
-load_dotenv()
+DATABASE_NAME = 'money_tracker'
 
-# MongoDB connection
-client = MongoClient(os.getenv('MONGODB_URI'))
-db = client.money_tracker
+logger = logging.getLogger(__name__)
+
+# MongoDB connection. The client is created lazily on first use in each
+# process, so a gunicorn master that preloads the app never hands a client
+# (and its sockets and monitor threads) to forked workers.
+_client = None
+_client_pid = None
+_client_uri = None
+_client_database = DATABASE_NAME
+_client_options = {}
+_client_lock = threading.Lock()
+
+def configure(uri, database=DATABASE_NAME, **client_options):
+    # Set the URI, database name and MongoClient keyword arguments used for
+    # new clients
+    global _client_uri, _client_database, _client_options
+    _client_uri = uri
+    _client_database = database
+    _client_options = client_options
+    reset_client()
+
+def reset_client():
+    # Forget the current client; the next database access creates a new one.
+    # The old client is not closed since it may belong to the parent process.
+    global _client, _client_pid, _client_lock
+    _client = None
+    _client_pid = None
+    _client_lock = threading.Lock()
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = MongoClient(
+                    _client_uri or os.getenv('MONGODB_URI'),
+                    event_listeners=[metrics.command_listener],
+                    **_client_options
+                )
+                _client_pid = pid
+    return _client
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_client)
+
+class _Database:
+    # Resolves `db.<collection>` against the current process's client
+    def __getattr__(self, name):
+        return getattr(get_client()[_client_database], name)
+
+    def __getitem__(self, name):
+        return get_client()[_client_database][name]
+
+db = _Database()
+
+# Optional write-behind queue for expense and salary inserts, see
+# enable_write_behind
+_write_behind = None
+_write_behind_concern = None
+
+def enable_write_behind(write_queue, write_concern=None):
+    # Route Expense.create and Salary.create through `write_queue`, which
+    # must call write_pending with batches of (collection, document) items
+    # and retry the items it returns. Deletes cancel still-queued documents
+    # when the queue tracks items with write_behind_key.
+    global _write_behind, _write_behind_concern
+    _write_behind = write_queue
+    _write_behind_concern = write_concern
+
+def flush_write_behind():
+    if _write_behind is not None:
+        _write_behind.close()
+
+def write_behind_key(item):
+    collection, doc = item[:2]
+    return (collection, str(doc['_id']), doc['user_id'])
+
+def _cancel_queued(collection, doc_id, user_id):
+    # True when the document was still waiting in the write-behind queue and
+    # has been dropped from it. A document a flush is already writing is
+    # waited for, so the delete that follows finds it.
+    return _write_behind is not None and _write_behind.cancel((collection, str(doc_id), user_id))
+
+def write_pending(batch):
+    # Documents are grouped per collection and user so each group costs one
+    # insert_many plus one rollup update. Items are (collection, document)
+    # or, when retried, (collection, document, step) naming the step of
+    # _insert_and_apply to resume from. A group that fails does not stop the
+    # others; its documents are returned as items for the step that failed,
+    # so a retry never repeats a rollup or search term update.
+    groups = {}
+    for item in batch:
+        collection, doc = item[:2]
+        step = item[2] if len(item) > 2 else 0
+        groups.setdefault((collection, doc['user_id'], step), []).append(doc)
+    retry = []
+    for (collection, user_id, step), docs in groups.items():
+        model = Expense if collection == 'expenses' else Salary
+        progress = {'step': step, 'docs': docs}
+        try:
+            _, failed = model._insert_docs(user_id, docs, _write_behind_concern, progress)
+        except Exception:
+            logger.exception('Write-behind %s for user %s failed at step %d', collection, user_id, progress['step'])
+            retry.extend((collection, doc, progress['step']) for doc in progress['docs'])
+            continue
+        for index, message in failed.items():
+            logger.error('Write-behind %s insert rejected: %s', collection, message)
+    return retry
+
+# Authenticated user lookups. Invalidation is per process, so other workers
+# see user changes once the TTL expires.
+user_cache = TTLCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', 1024)),
+    ttl=float(os.getenv('USER_CACHE_TTL', 300))
+)
+
+def _millis(value):
+    # BSON dates only hold milliseconds; truncating before the insert makes a
+    # new document serialize exactly like it will when read back
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+def _duplicate_id(error):
+    # Servers before 4.2 omit keyPattern; expenses and salaries have no other
+    # unique index
+    return error.get('code') == 11000 and error.get('keyPattern', {'_id': 1}) == {'_id': 1}
+
+def _insert_and_apply(collection, user_id, docs, write_concern, apply_steps, progress=None):
+    # Insert `docs` with one unordered insert_many, then run each of
+    # `apply_steps` (rollup and search term updates) on the inserted
+    # documents, all under one data version reservation. Returns the
+    # inserted documents and {index: message} for rejected ones.
+    #
+    # With `progress`, progress['step'] is where to start (0 is the insert)
+    # and progress['docs'] the documents it applies to; both are kept up to
+    # date, so after an exception they describe the step that failed. Ids
+    # that already exist were inserted by an earlier attempt and still count
+    # as inserted.
+    progress = progress if progress is not None else {'step': 0, 'docs': docs}
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    failed = {}
+    inserted = progress['docs']
+    with DataVersion.writing(user_id) as version:
+        if progress['step'] == 0:
+            for doc in inserted:
+                doc['sync_version'] = version
+            try:
+                collection.insert_many(inserted, ordered=False)
+            except BulkWriteError as e:
+                failed = {
+                    error['index']: error['errmsg']
+                    for error in e.details['writeErrors'] if not _duplicate_id(error)
+                }
+            inserted = [doc for index, doc in enumerate(inserted) if index not in failed]
+            progress['docs'] = inserted
+            progress['step'] = 1
+        for apply in apply_steps[progress['step'] - 1:]:
+            apply(inserted)
+            progress['step'] += 1
+    return inserted, failed
+
+def _iso_date(field):
+    # Aggregation expression formatting a date field the way
+    # datetime.isoformat() does: no fraction when the milliseconds are zero,
+    # else six digits. Missing dates come out as null.
+    millis = {'$millisecond': field}
+    padding = {'$cond': [{'$lt': [millis, 10]}, '00', {'$cond': [{'$lt': [millis, 100]}, '0', '']}]}
+    return {'$cond': [
+        {'$eq': [millis, 0]},
+        {'$dateToString': {'date': field, 'format': '%Y-%m-%dT%H:%M:%S'}},
+        {'$concat': [
+            {'$dateToString': {'date': field, 'format': '%Y-%m-%dT%H:%M:%S.'}},
+            padding, {'$toString': millis}, '000'
+        ]}
+    ]}
+
+def _projection(fields):
+    # Restrict a query to `fields` (plus _id); None fetches whole documents
+    return {field: 1 for field in fields} if fields else None
 
 class User(UserMixin):
+    # UserMixin has no __slots__, so instances still carry a __dict__; the
+    # slots just keep the model's own attributes compact
+    __slots__ = ('id', 'email', 'username', 'password')
+
     def __init__(self, user_data):
         self.id = str(user_data['_id'])
-        self.email = user_data['email']
-        self.username = user_data['username']
-        self.password = user_data['password']
+        self.email = user_data.get('email')
+        self.username = user_data.get('username')
+        self.password = user_data.get('password')
 
     @staticmethod
-    def get(user_id):
-        user_data = db.users.find_one({'_id': ObjectId(user_id)})
+    def get(user_id, fields=None):
+        user_data = db.users.find_one({'_id': ObjectId(user_id)}, _projection(fields))
         return User(user_data) if user_data else None
 
+    @staticmethod
+    def get_cached(user_id):
+        # Cached users are loaded without the password hash, so they must not
+        # be used for password checks
+        user = user_cache.get(user_id)
+        if user is None:
+            user_data = db.users.find_one({'_id': ObjectId(user_id)}, {'password': 0})
+            if not user_data:
+                return None
+            user = User(user_data)
+            user_cache.set(user_id, user)
+        return user
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        user_cache.invalidate(str(user_id))
+
     @staticmethod
     def get_by_email(email):
         user_data = db.users.find_one({'email': email})
@@ -45,84 +250,745 @@ class User(UserMixin):
         user_data['_id'] = result.inserted_id
         return User(user_data)
 
+    @staticmethod
+    def update(user_id, fields):
+        db.users.update_one({'_id': ObjectId(user_id)}, {'$set': fields})
+        User.invalidate_cache(user_id)
+
+    @staticmethod
+    def delete(user_id):
+        db.users.delete_one({'_id': ObjectId(user_id)})
+        User.invalidate_cache(user_id)
+        RefreshToken.revoke_all(user_id)
+
 class Expense:
+    # Fields left out by a projection are None
+    __slots__ = ('id', 'amount', 'category', 'description', 'date',
+                 'transaction_type', 'user_id', 'timestamp')
+
     def __init__(self, expense_data):
         self.id = str(expense_data['_id'])
-        self.amount = expense_data['amount']
-        self.category = expense_data['category']
+        self.amount = expense_data.get('amount')
+        self.category = expense_data.get('category')
         self.description = expense_data.get('description', '')
-        self.date = expense_data['date']
-        self.transaction_type = expense_data['transaction_type']
-        self.user_id = expense_data['user_id']
+        self.date = expense_data.get('date')
+        self.transaction_type = expense_data.get('transaction_type')
+        self.user_id = expense_data.get('user_id')
         self.timestamp = expense_data.get('timestamp')
 
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'amount': self.amount,
+            'category': self.category,
+            'description': self.description,
+            'date': self.date.isoformat() if self.date else None,
+            'transaction_type': self.transaction_type,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None
+        }
+
     @staticmethod
     def create(amount, category, description, date, transaction_type, user_id):
         expense_data = {
             'amount': amount,
             'category': category,
             'description': description,
-            'date': date,
+            'date': _millis(date),
             'transaction_type': transaction_type,
             'user_id': user_id,
-            'timestamp': datetime.utcnow(),
+            'timestamp': _millis(datetime.utcnow()),
         }
-        result = db.expenses.insert_one(expense_data)
-        expense_data['_id'] = result.inserted_id
+        if _write_behind is not None:
+            # Queued for a batched insert; the id is generated here so the
+            # caller gets a complete expense back immediately
+            expense_data['_id'] = ObjectId()
+            _write_behind.put(('expenses', expense_data))
+            return Expense(expense_data)
+        with DataVersion.writing(user_id) as version:
+            expense_data['sync_version'] = version
+            result = db.expenses.insert_one(expense_data)
+            expense_data['_id'] = result.inserted_id
+            MonthlyRollup.apply_expense(expense_data)
+            SearchTerm.add([expense_data])
         return Expense(expense_data)
 
     @staticmethod
-    def get_by_user(user_id):
-        expenses = db.expenses.find({'user_id': user_id}).sort('date', -1)
-        return [Expense(expense) for expense in expenses]
+    def get_by_user(user_id, fields=None):
+        return list(Expense.iter_by_user(user_id, fields))
+
+    @staticmethod
+    def iter_by_user(user_id, fields=None, batch_size=1000):
+        # Stream a user's expenses, newest first, straight from the cursor
+        expenses = db.expenses.find({'user_id': user_id}, _projection(fields))
+        for expense in expenses.sort('date', -1).batch_size(batch_size):
+            yield Expense(expense)
+
+    @staticmethod
+    def create_many(user_id, rows):
+        # Insert a batch of validated rows (dicts with amount, category,
+        # description, date and transaction_type) with one unordered
+        # insert_many. Returns the number inserted and a list of
+        # (row index, message) for rows MongoDB rejected.
+        timestamp = _millis(datetime.utcnow())
+        docs = [dict(row, date=_millis(row['date']), user_id=user_id, timestamp=timestamp) for row in rows]
+        if not docs:
+            return 0, []
+        inserted, failed = Expense._insert_docs(user_id, docs)
+        return len(inserted), sorted(failed.items())
+
+    @staticmethod
+    def _insert_docs(user_id, docs, write_concern=None, progress=None):
+        # Shared by bulk import and the write-behind queue: the data version
+        # and rollups are updated once for the whole batch
+        return _insert_and_apply(db.expenses, user_id, docs, write_concern,
+                                 [MonthlyRollup.apply_expenses, SearchTerm.add], progress)
+
+    @staticmethod
+    def search(user_id, text, limit=50):
+        # Full-text search over description and category through the
+        # user_text index, best matches first
+        cursor = db.expenses.find(
+            {'user_id': user_id, '$text': {'$search': text}},
+            {'score': {'$meta': 'textScore'}}
+        )
+        cursor = cursor.sort([('score', {'$meta': 'textScore'}), ('date', -1)]).limit(limit)
+        return [Expense(expense) for expense in cursor]
+
+    @staticmethod
+    def get_changes(user_id, since=None):
+        # Expenses written after data version `since`; all of them when None
+        query = {'user_id': user_id}
+        if since is not None:
+            query['sync_version'] = {'$gt': since}
+        return [Expense(expense) for expense in db.expenses.find(query)]
+
+    @staticmethod
+    def iter_range(user_id, date_from=None, date_to=None, fields=None, batch_size=1000):
+        # Stream a user's expenses oldest first without materializing them
+        query = {'user_id': user_id}
+        if date_from or date_to:
+            query['date'] = {}
+            if date_from:
+                query['date']['$gte'] = date_from
+            if date_to:
+                query['date']['$lt'] = date_to
+        cursor = db.expenses.find(query, _projection(fields))
+        for expense in cursor.sort([('date', 1), ('_id', 1)]).batch_size(batch_size):
+            yield Expense(expense)
+
+    @staticmethod
+    def _page_query(user_id, after=None, date_from=None, date_to=None,
+                    category=None, transaction_type=None):
+        query = {'user_id': user_id}
+        if date_from or date_to:
+            query['date'] = {}
+            if date_from:
+                query['date']['$gte'] = date_from
+            if date_to:
+                query['date']['$lt'] = date_to
+        if category:
+            query['category'] = category
+        if transaction_type:
+            query['transaction_type'] = transaction_type
+        if after:
+            after_date, after_id = after
+            query = {'$and': [query, {'$or': [
+                {'date': {'$lt': after_date}},
+                {'date': after_date, '_id': {'$lt': after_id}}
+            ]}]}
+        return query
+
+    # Aggregation projection that shapes rows exactly like Expense.to_dict,
+    # so list endpoints can encode them without building an Expense per row
+    API_PROJECTION = {
+        '_id': 0,
+        'id': {'$toString': '$_id'},
+        'amount': {'$ifNull': ['$amount', None]},
+        'category': {'$ifNull': ['$category', None]},
+        'description': {'$ifNull': ['$description', '']},
+        'date': _iso_date('$date'),
+        'transaction_type': {'$ifNull': ['$transaction_type', None]},
+        'timestamp': _iso_date('$timestamp')
+    }
+
+    @staticmethod
+    def get_page(user_id, limit, after=None, **filters):
+        # Keyset pagination ordered by (date, _id) descending. `after` is the
+        # (date, _id) of the last row of the previous page. Returns the page
+        # as API-shaped dicts and the key to continue from, or None when
+        # there are no more rows.
+        query = Expense._page_query(user_id, after, **filters)
+        rows = list(db.expenses.aggregate([
+            {'$match': query},
+            {'$sort': {'date': -1, '_id': -1}},
+            {'$limit': limit + 1},
+            {'$project': Expense.API_PROJECTION}
+        ]))
+        next_key = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_key = (datetime.fromisoformat(rows[-1]['date']), ObjectId(rows[-1]['id']))
+        return rows, next_key
 
     @staticmethod
     def delete(expense_id, user_id):
-        db.expenses.delete_one({'_id': ObjectId(expense_id), 'user_id': user_id})
+        if _cancel_queued('expenses', expense_id, user_id):
+            return
+        with DataVersion.writing(user_id) as version:
+            expense_data = db.expenses.find_one_and_delete({'_id': ObjectId(expense_id), 'user_id': user_id})
+            if expense_data:
+                MonthlyRollup.apply_expense(expense_data, sign=-1)
+                SearchTerm.add([expense_data], sign=-1)
+                Tombstone.record('expenses', expense_data['_id'], user_id, version)
 
 class Salary:
+    __slots__ = ('id', 'amount', 'date', 'user_id')
+
     def __init__(self, salary_data):
         self.id = str(salary_data['_id'])
-        self.amount = salary_data['amount']
-        self.date = salary_data['date']
-        self.user_id = salary_data['user_id']
+        self.amount = salary_data.get('amount')
+        self.date = salary_data.get('date')
+        self.user_id = salary_data.get('user_id')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'amount': self.amount,
+            'date': self.date.isoformat() if self.date else None
+        }
 
     @staticmethod
     def create(amount, date, user_id):
         salary_data = {
             'amount': amount,
-            'date': date,
+            'date': _millis(date),
             'user_id': user_id
         }
-        result = db.salaries.insert_one(salary_data)
-        salary_data['_id'] = result.inserted_id
+        if _write_behind is not None:
+            salary_data['_id'] = ObjectId()
+            _write_behind.put(('salaries', salary_data))
+            return Salary(salary_data)
+        with DataVersion.writing(user_id) as version:
+            salary_data['sync_version'] = version
+            result = db.salaries.insert_one(salary_data)
+            salary_data['_id'] = result.inserted_id
+            MonthlyRollup.apply_salary(salary_data)
         return Salary(salary_data)
 
     @staticmethod
-    def get_by_user(user_id):
-        salaries = db.salaries.find({'user_id': user_id}).sort('date', -1)
-        return [Salary(salary) for salary in salaries]
+    def _insert_docs(user_id, docs, write_concern=None, progress=None):
+        return _insert_and_apply(db.salaries, user_id, docs, write_concern,
+                                 [MonthlyRollup.apply_salaries], progress)
+
+    @staticmethod
+    def get_by_user(user_id, fields=None):
+        return list(Salary.iter_by_user(user_id, fields))
+
+    @staticmethod
+    def iter_by_user(user_id, fields=None, batch_size=1000):
+        salaries = db.salaries.find({'user_id': user_id}, _projection(fields))
+        for salary in salaries.sort('date', -1).batch_size(batch_size):
+            yield Salary(salary)
+
+    @staticmethod
+    def get_changes(user_id, since=None):
+        query = {'user_id': user_id}
+        if since is not None:
+            query['sync_version'] = {'$gt': since}
+        return [Salary(salary) for salary in db.salaries.find(query)]
 
     @staticmethod
     def delete(salary_id, user_id):
-        db.salaries.delete_one({'_id': ObjectId(salary_id), 'user_id': user_id})
+        if _cancel_queued('salaries', salary_id, user_id):
+            return
+        with DataVersion.writing(user_id) as version:
+            salary_data = db.salaries.find_one_and_delete({'_id': ObjectId(salary_id), 'user_id': user_id})
+            if salary_data:
+                MonthlyRollup.apply_salary(salary_data, sign=-1)
+                Tombstone.record('salaries', salary_data['_id'], user_id, version)
+
+class DataVersion:
+    # Per-user counter advanced on every expense, salary, category and
+    # tombstone write. Global categories are tracked under a shared key that
+    # every user's reads depend on.
+    #
+    # A write reserves its version before touching the data and publishes it
+    # afterwards (see writing). While a reserved version is unpublished the
+    # key is unsettled and readers get `published` instead, the newest
+    # version with nothing still in flight below it. A sync token therefore
+    # never passes a document that is not written yet, and nothing is cached
+    # under a version whose data is incomplete.
+    GLOBAL = 'global'
+    # Reservations left open this long belong to a writer that died
+    PENDING_TIMEOUT = timedelta(seconds=60)
+
+    @staticmethod
+    def reserve(key):
+        doc = db.data_versions.find_one_and_update(
+            {'_id': str(key)},
+            {'$inc': {'version': 1, 'pending': 1}, '$set': {'reserved_at': datetime.utcnow()}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return doc['version']
+
+    @staticmethod
+    def publish(key, version):
+        key = str(key)
+        # Usually this was the only write in flight
+        result = db.data_versions.update_one(
+            {'_id': key, 'version': version, 'pending': 1},
+            {'$set': {'pending': 0, 'published': version}}
+        )
+        if result.modified_count:
+            return
+        doc = db.data_versions.find_one_and_update(
+            {'_id': key, 'pending': {'$gt': 0}},
+            {'$inc': {'pending': -1}},
+            return_document=ReturnDocument.AFTER
+        )
+        if doc is not None and doc['pending'] == 0:
+            # Only valid while no other write has reserved a version since
+            db.data_versions.update_one(
+                {'_id': key, 'version': doc['version'], 'pending': 0},
+                {'$max': {'published': doc['version']}}
+            )
+
+    @staticmethod
+    @contextmanager
+    def writing(key):
+        # with DataVersion.writing(user_id) as version: stamp and write docs
+        version = DataVersion.reserve(key)
+        try:
+            yield version
+        finally:
+            DataVersion.publish(key, version)
+
+    @staticmethod
+    def _resolve(doc, now):
+        # Returns (readable version, settled) for a data_versions document
+        if doc is None or doc.get('pending', 0) <= 0:
+            return (doc['version'] if doc else 0), True
+        if doc['reserved_at'] < now - DataVersion.PENDING_TIMEOUT:
+            # Drop the abandoned reservations, unless a write came in since
+            db.data_versions.update_one(
+                {'_id': doc['_id'], 'version': doc['version'], 'reserved_at': doc['reserved_at']},
+                {'$set': {'pending': 0, 'published': doc['version']}}
+            )
+            return doc['version'], True
+        return doc.get('published', 0), False
+
+    @staticmethod
+    def current(key):
+        return DataVersion._resolve(db.data_versions.find_one({'_id': str(key)}), datetime.utcnow())
+
+    @staticmethod
+    def get(user_id):
+        # Returns (user_version, global_version, settled) in a single round
+        # trip; settled is False while a write to either key is in flight
+        now = datetime.utcnow()
+        docs = {
+            doc['_id']: doc
+            for doc in db.data_versions.find({'_id': {'$in': [str(user_id), DataVersion.GLOBAL]}})
+        }
+        user_version, user_settled = DataVersion._resolve(docs.get(str(user_id)), now)
+        global_version, global_settled = DataVersion._resolve(docs.get(DataVersion.GLOBAL), now)
+        return user_version, global_version, user_settled and global_settled
+
+class SearchTerm:
+    # Per-user autocomplete terms: each distinct category and description
+    # with the number of expenses using it. Terms are stored lowercased so
+    # an anchored regex is a range scan on the (user_id, kind, term) index.
+    KINDS = ('category', 'description')
+    MAX_LENGTH = 100
+
+    @staticmethod
+    def normalize(value):
+        return ' '.join(value.split()).lower()[:SearchTerm.MAX_LENGTH] if value else ''
+
+    @staticmethod
+    def _counts(expenses):
+        counts = {}
+        for expense in expenses:
+            for kind in SearchTerm.KINDS:
+                display = ' '.join((expense.get(kind) or '').split())[:SearchTerm.MAX_LENGTH]
+                term = display.lower()
+                if term:
+                    key = (expense['user_id'], kind, term)
+                    count, _ = counts.get(key, (0, display))
+                    counts[key] = (count + 1, display)
+        return counts
+
+    @staticmethod
+    def add(expenses, sign=1):
+        # Count (or with sign=-1 uncount) the expenses' terms in one bulk write
+        counts = SearchTerm._counts(expenses)
+        if not counts:
+            return
+        db.search_terms.bulk_write([
+            UpdateOne(
+                {'user_id': user_id, 'kind': kind, 'term': term},
+                {'$inc': {'count': sign * count}, '$set': {'display': display}},
+                upsert=sign > 0
+            )
+            for (user_id, kind, term), (count, display) in counts.items()
+        ], ordered=False)
+        if sign < 0:
+            db.search_terms.delete_many({'user_id': expenses[0]['user_id'], 'count': {'$lte': 0}})
+
+    @staticmethod
+    def suggest(user_id, prefix, kind=None, limit=10):
+        query = {'user_id': user_id, 'term': {'$regex': '^' + re.escape(SearchTerm.normalize(prefix))}}
+        if kind:
+            query['kind'] = kind
+        cursor = db.search_terms.find(query, {'_id': 0, 'kind': 1, 'display': 1, 'count': 1})
+        return list(cursor.sort([('count', -1), ('term', 1)]).limit(limit))
+
+    @staticmethod
+    def rebuild(user_id=None):
+        # Replaced in place like MonthlyRollup.rebuild, so concurrent $inc
+        # upserts never hit a duplicate key on the unique term index
+        query = {'user_id': user_id} if user_id else {}
+        stored = {
+            (doc['user_id'], doc['kind'], doc['term'])
+            for doc in db.search_terms.find(query, {'user_id': 1, 'kind': 1, 'term': 1})
+        }
+        cursor = db.expenses.find(
+            query, {'_id': 0, 'user_id': 1, 'category': 1, 'description': 1}
+        ).batch_size(10000)
+        counts = SearchTerm._counts(cursor)
+        requests = [
+            ReplaceOne(
+                {'user_id': key[0], 'kind': key[1], 'term': key[2]},
+                {'user_id': key[0], 'kind': key[1], 'term': key[2], 'display': display, 'count': count},
+                upsert=True
+            )
+            for key, (count, display) in counts.items()
+        ]
+        requests += [
+            DeleteOne({'user_id': key[0], 'kind': key[1], 'term': key[2]})
+            for key in stored - set(counts)
+        ]
+        if requests:
+            db.search_terms.bulk_write(requests, ordered=False)
+        return len(counts)
+
+class Tombstone:
+    # Deletions are recorded here so delta syncs can tell clients which
+    # documents to drop. Deletes record their tombstone inside the same
+    # DataVersion.writing block as the delete itself. A TTL index on
+    # deleted_at drops them after RETENTION, so sync tokens older than that
+    # get a full resync instead of a delta.
+    RETENTION = timedelta(days=30)
+
+    @staticmethod
+    def record(collection, doc_id, user_id, version):
+        db.tombstones.insert_one({
+            'collection': collection,
+            'doc_id': str(doc_id),
+            'user_id': str(user_id),
+            'sync_version': version,
+            'deleted_at': datetime.utcnow()
+        })
+
+    @staticmethod
+    def get_since(user_id, since):
+        # Returns {collection: [doc_id, ...]} for deletions after `since`
+        deleted = {}
+        query = {'user_id': str(user_id), 'sync_version': {'$gt': since}}
+        for doc in db.tombstones.find(query, {'collection': 1, 'doc_id': 1}):
+            deleted.setdefault(doc['collection'], []).append(doc['doc_id'])
+        return deleted
+
+def _category_field(category):
+    # Category names are used as field names inside rollup documents
+    return category.replace('$', '\uff04').replace('.', '\uff0e')
+
+def _category_name(field):
+    return field.replace('\uff04', '$').replace('\uff0e', '.')
+
+class MonthlyRollup:
+    # One document per (user_id, 'YYYY-MM') with the month's CR/DR totals,
+    # per-category debit sums and salary totals, kept current with $inc
+    # upserts on every expense/salary write.
+    FIELDS = ['credit_total', 'credit_count', 'debit_total', 'debit_count',
+              'salary_total', 'salary_count']
+
+    @staticmethod
+    def month_key(date):
+        return date.strftime('%Y-%m')
+
+    @staticmethod
+    def _increment(user_id, month, inc):
+        db.monthly_rollups.update_one(
+            {'user_id': user_id, 'month': month},
+            {'$inc': inc},
+            upsert=True
+        )
+
+    @staticmethod
+    def _expense_inc(expense_data, sign=1):
+        amount = sign * expense_data['amount']
+        if expense_data['transaction_type'] == 'CR':
+            return {'credit_total': amount, 'credit_count': sign}
+        field = _category_field(expense_data['category'])
+        return {
+            'debit_total': amount,
+            'debit_count': sign,
+            f'category_spending.{field}': amount,
+            f'category_counts.{field}': sign
+        }
+
+    @staticmethod
+    def apply_expense(expense_data, sign=1):
+        inc = MonthlyRollup._expense_inc(expense_data, sign)
+        MonthlyRollup._increment(expense_data['user_id'], MonthlyRollup.month_key(expense_data['date']), inc)
+
+    @staticmethod
+    def _apply_many(docs, inc_for):
+        # Fold many inserted documents into one $inc per (user, month)
+        incs = {}
+        for doc in docs:
+            key = (doc['user_id'], MonthlyRollup.month_key(doc['date']))
+            inc = incs.setdefault(key, {})
+            for field, value in inc_for(doc).items():
+                inc[field] = inc.get(field, 0) + value
+        if incs:
+            db.monthly_rollups.bulk_write([
+                UpdateOne({'user_id': user_id, 'month': month}, {'$inc': inc}, upsert=True)
+                for (user_id, month), inc in incs.items()
+            ], ordered=False)
+
+    @staticmethod
+    def apply_expenses(expenses):
+        MonthlyRollup._apply_many(expenses, MonthlyRollup._expense_inc)
+
+    @staticmethod
+    def _salary_inc(salary_data, sign=1):
+        return {'salary_total': sign * salary_data['amount'], 'salary_count': sign}
+
+    @staticmethod
+    def apply_salary(salary_data, sign=1):
+        inc = MonthlyRollup._salary_inc(salary_data, sign)
+        MonthlyRollup._increment(salary_data['user_id'], MonthlyRollup.month_key(salary_data['date']), inc)
+
+    @staticmethod
+    def apply_salaries(salaries):
+        MonthlyRollup._apply_many(salaries, MonthlyRollup._salary_inc)
+
+    @staticmethod
+    def _to_summary(doc):
+        summary = {field: doc.get(field, 0) for field in MonthlyRollup.FIELDS}
+        summary['month'] = doc.get('month')
+        counts = doc.get('category_counts', {})
+        # Categories whose debits were all deleted keep a zero entry; hide them
+        summary['category_spending'] = {
+            _category_name(field): total
+            for field, total in doc.get('category_spending', {}).items()
+            if counts.get(field, 0) > 0
+        }
+        return summary
+
+    @staticmethod
+    def empty(month):
+        return MonthlyRollup._to_summary({'month': month})
+
+    @staticmethod
+    def get(user_id, month):
+        doc = db.monthly_rollups.find_one({'user_id': user_id, 'month': month})
+        return MonthlyRollup._to_summary(doc) if doc else MonthlyRollup.empty(month)
+
+    @staticmethod
+    def get_range(user_id, start_month=None, end_month=None):
+        query = {'user_id': user_id}
+        if start_month or end_month:
+            query['month'] = {}
+            if start_month:
+                query['month']['$gte'] = start_month
+            if end_month:
+                query['month']['$lte'] = end_month
+        docs = db.monthly_rollups.find(query).sort('month', 1)
+        return [MonthlyRollup._to_summary(doc) for doc in docs]
+
+    @staticmethod
+    def get_salary_overview(user_id, current_month, start_month=None, end_month=None):
+        # One $facet aggregation over the user's rollups: salary totals per
+        # month (optionally limited to [start_month, end_month]) and the
+        # current month's salary and CR/DR totals
+        month_range = {}
+        if start_month:
+            month_range['$gte'] = start_month
+        if end_month:
+            month_range['$lte'] = end_month
+        match = {'user_id': user_id}
+        salary_match = {'salary_count': {'$gt': 0}}
+        if month_range:
+            match['$or'] = [{'month': month_range}, {'month': current_month}]
+            salary_match['month'] = month_range
+        pipeline = [
+            {'$match': match},
+            {'$facet': {
+                'salaries': [
+                    {'$match': salary_match},
+                    {'$sort': {'month': 1}},
+                    {'$project': {'_id': 0, 'month': 1, 'salary_total': 1}}
+                ],
+                'current': [
+                    {'$match': {'month': current_month}},
+                    {'$project': {'_id': 0, 'salary_total': 1, 'credit_total': 1, 'debit_total': 1}}
+                ]
+            }}
+        ]
+        result = next(db.monthly_rollups.aggregate(pipeline), {'salaries': [], 'current': []})
+        current = result['current'][0] if result['current'] else {}
+        return {
+            'salaries': [(row['month'], row['salary_total']) for row in result['salaries']],
+            'current_salary': current.get('salary_total', 0),
+            'current_credits': current.get('credit_total', 0),
+            'current_debits': current.get('debit_total', 0)
+        }
+
+    @staticmethod
+    def compute(user_id=None):
+        # Recompute rollup documents from the raw collections
+        match = {'user_id': user_id} if user_id else {}
+        month = {'$dateToString': {'format': '%Y-%m', 'date': '$date'}}
+        rollups = {}
+
+        def rollup_for(key):
+            if key not in rollups:
+                rollups[key] = dict({field: 0 for field in MonthlyRollup.FIELDS},
+                                    user_id=key[0], month=key[1],
+                                    category_spending={}, category_counts={})
+            return rollups[key]
+
+        expense_groups = db.expenses.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'month': month,
+                        'type': '$transaction_type', 'category': '$category'},
+                'total': {'$sum': '$amount'},
+                'count': {'$sum': 1}
+            }}
+        ])
+        for group in expense_groups:
+            key = group['_id']
+            rollup = rollup_for((key['user_id'], key['month']))
+            if key['type'] == 'CR':
+                rollup['credit_total'] += group['total']
+                rollup['credit_count'] += group['count']
+            else:
+                field = _category_field(key['category'])
+                rollup['debit_total'] += group['total']
+                rollup['debit_count'] += group['count']
+                rollup['category_spending'][field] = rollup['category_spending'].get(field, 0) + group['total']
+                rollup['category_counts'][field] = rollup['category_counts'].get(field, 0) + group['count']
+
+        salary_groups = db.salaries.aggregate([
+            {'$match': match},
+            {'$group': {
+                '_id': {'user_id': '$user_id', 'month': month},
+                'total': {'$sum': '$amount'},
+                'count': {'$sum': 1}
+            }}
+        ])
+        for group in salary_groups:
+            rollup = rollup_for((group['_id']['user_id'], group['_id']['month']))
+            rollup['salary_total'] += group['total']
+            rollup['salary_count'] += group['count']
+
+        return rollups
+
+    @staticmethod
+    def rebuild(user_id=None):
+        # Rollups are replaced in place rather than deleted and reinserted, so
+        # a concurrent $inc upsert never races a missing document into a
+        # duplicate key. Months that no longer have any data are dropped.
+        query = {'user_id': user_id} if user_id else {}
+        stored = {(doc['user_id'], doc['month']) for doc in db.monthly_rollups.find(query, {'user_id': 1, 'month': 1})}
+        rollups = MonthlyRollup.compute(user_id)
+        requests = [
+            ReplaceOne({'user_id': key[0], 'month': key[1]}, rollup, upsert=True)
+            for key, rollup in rollups.items()
+        ]
+        requests += [
+            DeleteOne({'user_id': key[0], 'month': key[1]})
+            for key in stored - set(rollups)
+        ]
+        if requests:
+            db.monthly_rollups.bulk_write(requests, ordered=False)
+        return len(rollups)
+
+    @staticmethod
+    def check_drift(user_id=None, tolerance=0.005):
+        # Compare stored rollups with freshly computed ones and return a list
+        # of (user_id, month, field, stored, expected) differences
+        expected = MonthlyRollup.compute(user_id)
+        stored = {
+            (doc['user_id'], doc['month']): doc
+            for doc in db.monthly_rollups.find({'user_id': user_id} if user_id else {})
+        }
+        drift = []
+        for key in set(expected) | set(stored):
+            want = MonthlyRollup._to_summary(expected.get(key, {}))
+            have = MonthlyRollup._to_summary(stored.get(key, {}))
+            for field in MonthlyRollup.FIELDS:
+                if abs(have[field] - want[field]) > tolerance:
+                    drift.append((key[0], key[1], field, have[field], want[field]))
+            for category in set(want['category_spending']) | set(have['category_spending']):
+                have_total = have['category_spending'].get(category, 0)
+                want_total = want['category_spending'].get(category, 0)
+                if abs(have_total - want_total) > tolerance:
+                    drift.append((key[0], key[1], f'category_spending.{category}', have_total, want_total))
+        return sorted(drift, key=lambda row: (str(row[0]), row[1], row[2]))
 
 class Category:
+    FIELDS = {'_id': 1, 'name': 1, 'is_global': 1}
+    # (global version, docs) for the global categories, shared by all
+    # requests in this process and reloaded when the global version moves
+    _global_cache = None
+
     @staticmethod
-    def get_by_user(user_id):
+    def get_global(global_version=None):
+        if global_version is None:
+            global_version, _ = DataVersion.current(DataVersion.GLOBAL)
+        cached = Category._global_cache
+        if cached is not None and cached[0] == global_version:
+            return cached[1]
+        docs = list(db.categories.find({'is_global': True}, Category.FIELDS))
+        Category._global_cache = (global_version, docs)
+        return docs
+
+    @staticmethod
+    def invalidate_global():
+        Category._global_cache = None
+
+    @staticmethod
+    def get_by_user(user_id, global_version=None):
         # Ensure user_id is an ObjectId
         if not isinstance(user_id, ObjectId):
             try:
                 user_id = ObjectId(user_id)
             except Exception:
                 pass
-        # Return both global and user categories
-        return list(db.categories.find({
-            '$or': [
-                {'is_global': True},
-                {'user_id': user_id, 'is_global': False}
-            ]
-        }))
+        # Global categories come from the in-process cache; the user's own are
+        # a query covered by the user_global_name index. No hint, so the query
+        # still works before indexes.py has created it.
+        own = db.categories.find({'user_id': user_id, 'is_global': False}, Category.FIELDS)
+        return Category.get_global(global_version) + list(own)
+
+    @staticmethod
+    def get_changes(user_id, since=None, global_since=None):
+        # Categories written after the given user and global data versions
+        if not isinstance(user_id, ObjectId):
+            user_id = ObjectId(user_id)
+        global_query = {'is_global': True}
+        user_query = {'user_id': user_id, 'is_global': False}
+        if global_since is not None:
+            global_query['sync_version'] = {'$gt': global_since}
+        if since is not None:
+            user_query['sync_version'] = {'$gt': since}
+        return list(db.categories.find({'$or': [global_query, user_query]}))
 
     @staticmethod
     def create(name, user_id=None, is_global=False):
@@ -135,12 +1001,17 @@ class Category:
                 except Exception:
                     pass
             doc['user_id'] = user_id
-        result = db.categories.insert_one(doc)
+        with DataVersion.writing(DataVersion.GLOBAL if is_global else user_id) as version:
+            doc['sync_version'] = version
+            result = db.categories.insert_one(doc)
+        if is_global:
+            Category.invalidate_global()
         return str(result.inserted_id)
 
     @staticmethod
     def delete(category_id, user_id):
-        # Convert IDs to ObjectId if needed
+        # Deletes the category only if it is one of the user's own, in a single
+        # round trip. Returns the deleted document or None.
         if not isinstance(category_id, ObjectId):
             try:
                 category_id = ObjectId(category_id)
@@ -151,4 +1022,73 @@ class Category:
                 user_id = ObjectId(user_id)
             except Exception:
                 pass
-        db.categories.delete_one({'_id': category_id, 'user_id': user_id}) 
\ No newline at end of file
+        with DataVersion.writing(user_id) as version:
+            deleted = db.categories.find_one_and_delete(
+                {'_id': category_id, 'user_id': user_id, 'is_global': False},
+                projection={'_id': 1}
+            )
+            if deleted:
+                Tombstone.record('categories', category_id, user_id, version)
+        return deleted
+
+class RefreshToken:
+    # Long-lived, single-use tokens traded for a new access token without
+    # checking the password. Only a SHA-256 of the token is stored, as _id.
+    # Every token descends from one login ("family"); presenting a token that
+    # was already used revokes the whole family, since either the client or
+    # a thief holds a stolen copy.
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @staticmethod
+    def issue(user_id, expires_in, family=None):
+        token = secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        db.refresh_tokens.insert_one({
+            '_id': RefreshToken._hash(token),
+            'user_id': str(user_id),
+            'family': family or secrets.token_hex(16),
+            'created_at': now,
+            # Removed by the TTL index once expired
+            'expires_at': now + expires_in,
+            'used_at': None,
+            'revoked': False
+        })
+        return token
+
+    @staticmethod
+    def rotate(token, expires_in):
+        # Returns (user_id, new token), or None if the token is unknown,
+        # expired, revoked or reused
+        now = datetime.utcnow()
+        token_hash = RefreshToken._hash(token)
+        doc = db.refresh_tokens.find_one_and_update(
+            {'_id': token_hash, 'used_at': None, 'revoked': False, 'expires_at': {'$gt': now}},
+            {'$set': {'used_at': now}},
+            projection={'user_id': 1, 'family': 1}
+        )
+        if doc:
+            return doc['user_id'], RefreshToken.issue(doc['user_id'], expires_in, doc['family'])
+        doc = db.refresh_tokens.find_one({'_id': token_hash}, {'family': 1, 'used_at': 1})
+        if doc and doc.get('used_at'):
+            RefreshToken._revoke_family(doc['family'])
+        return None
+
+    @staticmethod
+    def _revoke_family(family):
+        db.refresh_tokens.update_many({'family': family, 'revoked': False}, {'$set': {'revoked': True}})
+
+    @staticmethod
+    def revoke(token, user_id):
+        # Revokes the token's family if it belongs to the user
+        doc = db.refresh_tokens.find_one({'_id': RefreshToken._hash(token), 'user_id': str(user_id)}, {'family': 1})
+        if doc:
+            RefreshToken._revoke_family(doc['family'])
+        return bool(doc)
+
+    @staticmethod
+    def revoke_all(user_id):
+        return db.refresh_tokens.update_many(
+            {'user_id': str(user_id), 'revoked': False}, {'$set': {'revoked': True}}
+        ).modified_count
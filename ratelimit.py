@@ -0,0 +1,112 @@
+import math
+import threading
+import time
+from cache import SQLiteConnections, TTLCache
+from config import parse_float_map
+import metrics
+
+rate_limit_requests = metrics.registry.counter(
+    'rate_limit_requests_total', 'Rate limited requests by scope, endpoint and outcome')
+
+
+def refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+def take(tokens, cost, rate):
+    # Returns (tokens left, seconds until `cost` tokens are available or 0)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryStore:
+    # Buckets private to this process. An idle bucket refills completely
+    # within `ttl` seconds, so evicting it loses nothing.
+    def __init__(self, maxsize=100000, ttl=3600):
+        self._buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, rate, burst):
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, wait = take(refill(tokens, updated, now, rate, burst), cost, rate)
+            self._buckets.set(key, (tokens, now))
+            return wait
+
+
+class SQLiteStore:
+    # Buckets in a local SQLite file shared by every worker on the host.
+    # Each consume is one IMMEDIATE transaction, so concurrent workers
+    # cannot both spend the same tokens.
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self._connections = SQLiteConnections(path)
+        self._calls = 0
+        self._connections.get().execute(
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def consume(self, key, cost, rate, burst):
+        conn = self._connections.get()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, wait = take(refill(tokens, updated, now, rate, burst), cost, rate)
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            self._calls += 1
+            if self._calls % self.PRUNE_EVERY == 0:
+                # Buckets idle this long are full again; dropping them is free
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - self.ttl,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+
+class RateLimiter:
+    # Token buckets per key. `limits` maps a scope ('user', 'ip') to
+    # (tokens per second, burst size); `costs` maps endpoints to the tokens
+    # a request spends, 1 by default.
+    def __init__(self, store, limits, costs=None):
+        self.store = store
+        self.limits = limits
+        self.costs = costs or {}
+
+    def hit(self, scope, key, endpoint):
+        # Returns 0 when the request may proceed, else seconds to wait
+        rate, burst = self.limits[scope]
+        cost = self.costs.get(endpoint, 1)
+        wait = self.store.consume(f'{scope}:{key}', cost, rate, burst)
+        rate_limit_requests.inc(scope=scope, endpoint=endpoint, outcome='limited' if wait else 'allowed')
+        return wait
+
+
+def create_limiter(config):
+    limits = {
+        'user': (config['RATE_LIMIT_USER_RATE'], config['RATE_LIMIT_USER_BURST']),
+        'ip': (config['RATE_LIMIT_IP_RATE'], config['RATE_LIMIT_IP_BURST']),
+    }
+    # Long enough for any bucket to refill completely
+    ttl = max(burst / rate for rate, burst in limits.values())
+    if config['RATE_LIMIT_STORE'] == 'sqlite':
+        store = SQLiteStore(config['RATE_LIMIT_PATH'], ttl=ttl)
+    elif config['RATE_LIMIT_STORE'] == 'memory':
+        store = MemoryStore(ttl=ttl)
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_STORE {config['RATE_LIMIT_STORE']!r}")
+    costs = dict(config['RATE_LIMIT_DEFAULT_COSTS'], **parse_float_map(config['RATE_LIMIT_COSTS']))
+    return RateLimiter(store, limits, costs)
+
+
+def retry_after(wait):
+    return str(max(1, math.ceil(wait)))
@@ -0,0 +1,35 @@
+import argparse
+import sys
+from config import load_config, mongo_client_options
+from models import MonthlyRollup, SearchTerm, configure
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Maintain the monthly_rollups and search_terms collections')
+    parser.add_argument('command', choices=['rebuild', 'check', 'rebuild-terms'])
+    parser.add_argument('--user', help='Only process this user id')
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    configure(config['MONGODB_URI'], config['MONGODB_DATABASE'], **mongo_client_options(config))
+
+    if args.command == 'rebuild':
+        count = MonthlyRollup.rebuild(args.user)
+        print(f"rebuilt {count} monthly rollups")
+        return 0
+
+    if args.command == 'rebuild-terms':
+        count = SearchTerm.rebuild(args.user)
+        print(f"rebuilt {count} search terms")
+        return 0
+
+    drift = MonthlyRollup.check_drift(args.user)
+    for user_id, month, field, stored, expected in drift:
+        print(f"{user_id} {month} {field}: stored {stored}, expected {expected}")
+    if not drift:
+        print("no drift")
+    return 1 if drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
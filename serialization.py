@@ -0,0 +1,59 @@
+import json
+from datetime import date, datetime
+from bson import ObjectId
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'orjson' or 'json'; set from the JSON_BACKEND config in init_app
+_backend = 'orjson' if orjson else 'json'
+
+
+def default(obj):
+    # Types the API returns that neither encoder handles natively
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+class JSONEncoder(json.JSONEncoder):
+    # Used by Flask's own json helpers so they accept the same types
+    def default(self, obj):
+        try:
+            return default(obj)
+        except TypeError:
+            return super().default(obj)
+
+
+def dumps(obj):
+    if _backend == 'orjson':
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+def jsonify(*args, **kwargs):
+    # Drop-in replacement for flask.jsonify using the configured backend
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else (args or kwargs)
+    return current_app.response_class(dumps(data) + b'\n', mimetype=current_app.config.get('JSONIFY_MIMETYPE', 'application/json'))
+
+
+def init_app(app):
+    global _backend
+    backend = app.config.get('JSON_BACKEND', 'auto')
+    if backend == 'auto':
+        backend = 'orjson' if orjson else 'json'
+    if backend == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_BACKEND is orjson but orjson is not installed')
+    if backend not in ('orjson', 'json'):
+        raise ValueError(f'Unknown JSON_BACKEND {backend!r}')
+    _backend = backend
+    app.json_encoder = JSONEncoder
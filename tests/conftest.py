@@ -0,0 +1,47 @@
+import os
+import mongomock
+import pytest
+
+os.environ.setdefault('JWT_SECRET_KEY', 'test-jwt-secret-key-0123456789abcdef')
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+
+import models
+from models import Category
+from app import create_app
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # Every test gets its own empty in-memory database
+    monkeypatch.setattr(models, 'MongoClient', mongomock.MongoClient)
+    Category.invalidate_global()
+    app = create_app({
+        'TESTING': True,
+        'MONGODB_URI': 'mongodb://localhost',
+        'RATE_LIMIT_ENABLED': False,
+        'WRITE_BEHIND_ENABLED': False,
+        'RESPONSE_CACHE_BACKEND': 'none',
+        'LOG_LEVEL': 'WARNING',
+    })
+    yield app
+    models.reset_client()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def register(client, email='user@example.com', password='secret-password'):
+    response = client.post('/api/register', json={
+        'email': email,
+        'username': email.split('@')[0],
+        'password': password,
+        'confirm_password': password
+    })
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def auth_header(token):
+    return {'Authorization': f'Bearer {token}'}
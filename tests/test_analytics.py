@@ -0,0 +1,41 @@
+from datetime import date, datetime
+import analytics
+from models import Expense
+
+USER = '0123456789abcdef01234567'
+
+
+def test_buckets_add_up_to_the_expenses(app):
+    rows = [
+        (10.0, 'Food', datetime(2024, 1, 3, 8), 'DR'),
+        (2.5, 'Food', datetime(2024, 1, 3, 20), 'DR'),
+        (4, 'Rent', datetime(2024, 1, 3, 9), 'DR'),
+        (100.0, 'Salary', datetime(2024, 1, 3, 9), 'CR'),
+        (7.25, 'Food', datetime(2024, 2, 1), 'DR'),
+        (1.0, 'Food', datetime(2024, 3, 1), 'DR'),  # outside the range
+    ]
+    with app.app_context():
+        Expense.create_many(USER, [
+            {'amount': amount, 'category': category, 'description': '', 'date': when, 'transaction_type': kind}
+            for amount, category, when, kind in rows
+        ])
+        result = analytics.compute(USER, date(2024, 1, 1), date(2024, 2, 29))
+
+    assert result['transactions'] == 5
+    assert result['daily']['debit'][2] == 16.5
+    assert result['daily']['credit'][2] == 100.0
+    assert result['daily']['debit'][31] == 7.25
+    assert result['monthly']['debit'] == [16.5, 7.25]
+    assert result['monthly']['credit'] == [100.0, 0.0]
+    assert [(c['name'], c['total'], c['monthly']) for c in result['categories']] == [
+        ('Food', 19.75, [12.5, 7.25]),
+        ('Rent', 4.0, [4.0, 0.0]),
+    ]
+
+
+def test_empty_range(app):
+    with app.app_context():
+        result = analytics.compute(USER, date(2024, 1, 1), date(2024, 1, 31))
+    assert result['transactions'] == 0
+    assert result['daily']['debit'] == [0.0] * 31
+    assert result['categories'] == []
@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+from conftest import register, auth_header
+from models import DataVersion, Expense, Tombstone, db
+
+USER = '0123456789abcdef01234567'
+
+
+def expense(user_id, description):
+    return Expense.create(5.0, 'Food', description, datetime(2024, 1, 2), 'DR', user_id)
+
+
+def test_single_write_publishes_its_version(app):
+    with DataVersion.writing(USER) as version:
+        assert version == 1
+        assert DataVersion.get(USER) == (0, 0, False)
+    assert DataVersion.get(USER) == (1, 0, True)
+
+
+def test_overlapping_writers_finishing_in_order(app):
+    first = DataVersion.reserve(USER)
+    second = DataVersion.reserve(USER)
+    DataVersion.publish(USER, first)
+    # The second write is still in flight, so neither version is readable
+    assert DataVersion.get(USER) == (0, 0, False)
+    DataVersion.publish(USER, second)
+    assert DataVersion.get(USER) == (2, 0, True)
+
+
+def test_overlapping_writers_finishing_out_of_order(app):
+    first = DataVersion.reserve(USER)
+    second = DataVersion.reserve(USER)
+    DataVersion.publish(USER, second)
+    # Version 2 is done but 1 is not, so 2 must not be handed out yet
+    assert DataVersion.get(USER) == (0, 0, False)
+    DataVersion.publish(USER, first)
+    assert DataVersion.get(USER) == (2, 0, True)
+
+
+def test_published_version_advances_between_overlaps(app):
+    with DataVersion.writing(USER):
+        pass
+    in_flight = DataVersion.reserve(USER)
+    assert DataVersion.get(USER) == (1, 0, False)
+    DataVersion.publish(USER, in_flight)
+    assert DataVersion.get(USER) == (2, 0, True)
+
+
+def test_failed_write_still_publishes(app):
+    try:
+        with DataVersion.writing(USER):
+            raise RuntimeError('insert failed')
+    except RuntimeError:
+        pass
+    assert DataVersion.get(USER) == (1, 0, True)
+
+
+def test_global_write_in_flight_unsettles_every_user(app):
+    version = DataVersion.reserve(DataVersion.GLOBAL)
+    assert DataVersion.get(USER)[2] is False
+    DataVersion.publish(DataVersion.GLOBAL, version)
+    assert DataVersion.get(USER) == (0, 1, True)
+
+
+def test_versioned_response_has_no_etag_while_a_write_is_in_flight(client):
+    tokens = register(client)
+    headers = auth_header(tokens['token'])
+    version = DataVersion.reserve(tokens['user']['id'])
+    response = client.get('/api/dashboard', headers=headers)
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+    DataVersion.publish(tokens['user']['id'], version)
+    response = client.get('/api/dashboard', headers=headers)
+    assert response.headers['ETag']
+    assert client.get('/api/dashboard', headers=dict(headers, **{'If-None-Match': response.headers['ETag']})).status_code == 304
+
+
+def test_sync_token_does_not_pass_an_in_flight_document(client):
+    tokens = register(client)
+    user_id = tokens['user']['id']
+    headers = auth_header(tokens['token'])
+
+    # A slow writer has its version but has not inserted yet, while a later
+    # write completes
+    slow = DataVersion.reserve(user_id)
+    expense(user_id, 'fast')
+    body = client.get('/api/sync', headers=headers).get_json()
+    assert [e['description'] for e in body['expenses']] == ['fast']
+    token = body['token']
+    assert int(token.split('.')[0]) < slow
+
+    db.expenses.insert_one({
+        'amount': 1.0, 'category': 'Food', 'description': 'slow', 'date': datetime(2024, 1, 3),
+        'transaction_type': 'DR', 'user_id': user_id, 'sync_version': slow
+    })
+    DataVersion.publish(user_id, slow)
+
+    body = client.get(f'/api/sync?since={token}', headers=headers).get_json()
+    assert 'slow' in [e['description'] for e in body['expenses']]
+    # Once settled the token covers everything
+    body = client.get(f"/api/sync?since={body['token']}", headers=headers).get_json()
+    assert body['expenses'] == []
+
+
+def test_stale_reservation_is_abandoned(app):
+    DataVersion.reserve(USER)
+    assert DataVersion.get(USER) == (0, 0, False)
+    db.data_versions.update_one(
+        {'_id': USER},
+        {'$set': {'reserved_at': datetime.utcnow() - DataVersion.PENDING_TIMEOUT - timedelta(seconds=1)}}
+    )
+    assert DataVersion.get(USER) == (1, 0, True)
+    doc = db.data_versions.find_one({'_id': USER})
+    assert doc['pending'] == 0
+    assert doc['published'] == 1
+    # Later writes publish normally again
+    with DataVersion.writing(USER):
+        pass
+    assert DataVersion.get(USER) == (2, 0, True)
+
+
+def test_recent_reservation_is_not_abandoned(app):
+    DataVersion.reserve(USER)
+    db.data_versions.update_one(
+        {'_id': USER},
+        {'$set': {'reserved_at': datetime.utcnow() - DataVersion.PENDING_TIMEOUT + timedelta(seconds=5)}}
+    )
+    assert DataVersion.get(USER) == (0, 0, False)
+
+
+def test_sync_returns_deletions_within_the_retention_window(client):
+    tokens = register(client)
+    headers = auth_header(tokens['token'])
+    created = expense(tokens['user']['id'], 'gone')
+    token = client.get('/api/sync', headers=headers).get_json()['token']
+    assert client.delete(f"/api/expenses/{str(created.id)}", headers=headers).status_code == 200
+    body = client.get(f'/api/sync?since={token}', headers=headers).get_json()
+    assert body['full'] is False
+    assert body['deleted']['expenses'] == [str(created.id)]
+
+
+def test_sync_token_older_than_retention_gets_a_full_resync(client):
+    tokens = register(client)
+    headers = auth_header(tokens['token'])
+    expense(tokens['user']['id'], 'kept')
+    user_version, global_version, issued = client.get('/api/sync', headers=headers).get_json()['token'].split('.')
+    stale = int(issued) - int(Tombstone.RETENTION.total_seconds()) - 1
+    body = client.get(f'/api/sync?since={user_version}.{global_version}.{stale}', headers=headers).get_json()
+    assert body['full'] is True
+    assert [e['description'] for e in body['expenses']] == ['kept']
+    # Two-part tokens predate the issue time and are treated the same way
+    body = client.get(f'/api/sync?since={user_version}.{global_version}', headers=headers).get_json()
+    assert body['full'] is True
+
+
+def test_sync_rejects_malformed_tokens(client):
+    headers = auth_header(register(client)['token'])
+    for token in ('abc', '1', '1.2.3.4', '1.x.3'):
+        assert client.get(f'/api/sync?since={token}', headers=headers).status_code == 400
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+from conftest import register, auth_header
+from models import Expense
+
+
+def seed(app, user_id, count=12):
+    # Pairs of expenses share a date so the _id tiebreak is exercised
+    rows = [{
+        'amount': float(i + 1),
+        'category': 'Food' if i % 3 else 'Rent',
+        'description': f'expense {i}',
+        'date': datetime(2024, 1, 1) + timedelta(days=i // 2),
+        'transaction_type': 'CR' if i % 4 == 0 else 'DR'
+    } for i in range(count)]
+    with app.app_context():
+        Expense.create_many(user_id, rows)
+        return Expense.get_by_user(user_id)
+
+
+def walk(client, headers, query='', limit=5):
+    ids = []
+    cursor = None
+    pages = 0
+    while True:
+        url = f'/api/expenses?limit={limit}{query}' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        body = response.get_json()
+        assert len(body['expenses']) <= limit
+        ids.extend(expense['id'] for expense in body['expenses'])
+        pages += 1
+        cursor = body['next_cursor']
+        if not cursor:
+            return ids, pages
+
+
+def expected_order(expenses):
+    return [e.id for e in sorted(expenses, key=lambda e: (e.date, e.id), reverse=True)]
+
+
+def test_pages_cover_every_expense_once_in_order(app, client):
+    tokens = register(client)
+    expenses = seed(app, tokens['user']['id'])
+    ids, pages = walk(client, auth_header(tokens['token']))
+    assert ids == expected_order(expenses)
+    assert pages == 3
+
+
+def test_last_full_page_has_no_cursor(app, client):
+    tokens = register(client)
+    seed(app, tokens['user']['id'], count=10)
+    ids, pages = walk(client, auth_header(tokens['token']), limit=5)
+    assert len(ids) == 10
+    assert pages == 2
+
+
+def test_filters_apply_across_pages(app, client):
+    tokens = register(client)
+    expenses = seed(app, tokens['user']['id'])
+    ids, _ = walk(client, auth_header(tokens['token']), '&category=Food&from=2024-01-02&to=2024-01-05', limit=2)
+    wanted = [e for e in expenses
+              if e.category == 'Food' and datetime(2024, 1, 2) <= e.date < datetime(2024, 1, 6)]
+    assert ids == expected_order(wanted)
+
+
+def test_transaction_type_filter_across_pages(app, client):
+    tokens = register(client)
+    expenses = seed(app, tokens['user']['id'])
+    ids, _ = walk(client, auth_header(tokens['token']), '&transaction_type=CR', limit=1)
+    assert ids == expected_order([e for e in expenses if e.transaction_type == 'CR'])
+
+
+def test_page_size_defaults_to_config(app, client):
+    tokens = register(client)
+    seed(app, tokens['user']['id'], count=7)
+    app.config['EXPENSES_PAGE_SIZE'] = 4
+    body = client.get('/api/expenses', headers=auth_header(tokens['token'])).get_json()
+    assert len(body['expenses']) == 4
+    assert body['next_cursor']
+
+
+def test_pages_only_show_own_expenses(app, client):
+    first = register(client, 'first@example.com')
+    second = register(client, 'second@example.com')
+    seed(app, first['user']['id'])
+    ids, _ = walk(client, auth_header(second['token']))
+    assert ids == []
+
+
+def test_invalid_cursor_and_limit(client):
+    headers = auth_header(register(client)['token'])
+    assert client.get('/api/expenses?cursor=garbage', headers=headers).status_code == 400
+    assert client.get('/api/expenses?limit=0', headers=headers).status_code == 400
+    assert client.get('/api/expenses?limit=100000', headers=headers).status_code == 400
+    assert client.get('/api/expenses?limit=abc', headers=headers).status_code == 400
+    assert client.get('/api/expenses?transaction_type=XX', headers=headers).status_code == 400
+
+
+def test_rows_match_expense_to_dict(app):
+    user_id = '0123456789abcdef01234567'
+    with app.app_context():
+        for millis in (0, 7, 45, 999):
+            Expense.create(1.5, 'Food', f'at {millis}', datetime(2024, 3, 1, 12, 30, 5, millis * 1000), 'DR', user_id)
+        Expense.create(2.0, 'Rent', '', datetime(2024, 3, 2), 'CR', user_id)
+        rows, next_key = Expense.get_page(user_id, 3)
+        rows += Expense.get_page(user_id, 3, after=next_key)[0]
+        expected = sorted((e.to_dict() for e in Expense.get_by_user(user_id)),
+                          key=lambda e: (e['date'], e['id']), reverse=True)
+    assert rows == expected
+    assert [row['date'] for row in rows[1:]] == [
+        '2024-03-01T12:30:05.999000', '2024-03-01T12:30:05.045000',
+        '2024-03-01T12:30:05.007000', '2024-03-01T12:30:05'
+    ]
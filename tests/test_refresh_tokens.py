@@ -0,0 +1,87 @@
+from datetime import timedelta
+from conftest import register, auth_header
+from models import RefreshToken
+
+
+def refresh(client, token):
+    return client.post('/api/token/refresh', json={'refresh_token': token})
+
+
+def test_refresh_rotates_the_token(client):
+    tokens = register(client)
+    response = refresh(client, tokens['refresh_token'])
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['token']
+    assert body['refresh_token'] != tokens['refresh_token']
+    # The new access token works
+    assert client.get('/api/categories', headers=auth_header(body['token'])).status_code == 200
+    # and so does the new refresh token, once
+    assert refresh(client, body['refresh_token']).status_code == 200
+
+
+def test_used_token_is_rejected(client):
+    tokens = register(client)
+    assert refresh(client, tokens['refresh_token']).status_code == 200
+    response = refresh(client, tokens['refresh_token'])
+    assert response.status_code == 401
+    assert response.get_json()['message'] == 'Invalid refresh token'
+
+
+def test_replay_revokes_the_whole_family(client):
+    tokens = register(client)
+    rotated = refresh(client, tokens['refresh_token']).get_json()['refresh_token']
+    # Replaying the first token means it was stolen: its successor dies too
+    assert refresh(client, tokens['refresh_token']).status_code == 401
+    assert refresh(client, rotated).status_code == 401
+
+
+def test_replay_leaves_other_logins_alone(client):
+    tokens = register(client)
+    other = client.post('/api/login', json={'email': 'user@example.com', 'password': 'secret-password'})
+    other_token = other.get_json()['refresh_token']
+    refresh(client, tokens['refresh_token'])
+    refresh(client, tokens['refresh_token'])
+    assert refresh(client, other_token).status_code == 200
+
+
+def test_unknown_and_missing_tokens(client):
+    register(client)
+    assert refresh(client, 'not-a-token').status_code == 401
+    assert client.post('/api/token/refresh', json={}).status_code == 400
+
+
+def test_expired_token_is_rejected(app):
+    with app.app_context():
+        token = RefreshToken.issue('0123456789abcdef01234567', timedelta(seconds=-1))
+        assert RefreshToken.rotate(token, timedelta(days=1)) is None
+
+
+def test_logout_revokes_the_given_token(client):
+    tokens = register(client)
+    other = client.post('/api/login', json={'email': 'user@example.com', 'password': 'secret-password'})
+    other_token = other.get_json()['refresh_token']
+    response = client.post('/api/logout', json={'refresh_token': tokens['refresh_token']},
+                           headers=auth_header(tokens['token']))
+    assert response.status_code == 200
+    assert refresh(client, tokens['refresh_token']).status_code == 401
+    # Other devices stay logged in
+    assert refresh(client, other_token).status_code == 200
+
+
+def test_logout_all_revokes_every_token(client):
+    tokens = register(client)
+    other = client.post('/api/login', json={'email': 'user@example.com', 'password': 'secret-password'})
+    other_token = other.get_json()['refresh_token']
+    response = client.post('/api/logout', json={'all': True}, headers=auth_header(tokens['token']))
+    assert response.status_code == 200
+    assert refresh(client, tokens['refresh_token']).status_code == 401
+    assert refresh(client, other_token).status_code == 401
+
+
+def test_logout_ignores_another_users_token(client):
+    first = register(client, 'first@example.com')
+    second = register(client, 'second@example.com')
+    client.post('/api/logout', json={'refresh_token': second['refresh_token']},
+                headers=auth_header(first['token']))
+    assert refresh(client, second['refresh_token']).status_code == 200
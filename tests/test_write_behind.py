@@ -0,0 +1,197 @@
+import threading
+from datetime import datetime
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+import models
+from conftest import register, auth_header
+from models import MonthlyRollup, SearchTerm, db, write_behind_key, write_pending
+from writebehind import WriteBehindQueue
+
+
+def item(user_id, amount, description='coffee'):
+    return ('expenses', {
+        '_id': ObjectId(), 'amount': amount, 'category': 'Food', 'description': description,
+        'date': datetime(2024, 1, 5), 'transaction_type': 'DR', 'user_id': user_id,
+        'timestamp': datetime(2024, 1, 5, 9)
+    })
+
+
+def patch_step(monkeypatch, owner, name, failures=0):
+    # Replace the apply step owner.name with one that raises on its first
+    # `failures` calls; returns the list of calls that went through
+    original = getattr(owner, name)
+    calls = []
+    attempts = []
+
+    def step(docs, *args):
+        attempts.append(len(docs))
+        if len(attempts) <= failures:
+            raise AutoReconnect('connection lost')
+        calls.append(len(docs))
+        return original(docs, *args)
+
+    monkeypatch.setattr(owner, name, staticmethod(step))
+    return calls
+
+
+def count_inserts(monkeypatch):
+    collection_class = type(db.expenses)
+    original = collection_class.insert_many
+    calls = []
+
+    def insert_many(self, docs, *args, **kwargs):
+        calls.append(len(docs))
+        return original(self, docs, *args, **kwargs)
+
+    monkeypatch.setattr(collection_class, 'insert_many', insert_many)
+    return calls
+
+
+def term_count(user_id, term='coffee'):
+    return db.search_terms.find_one({'user_id': user_id, 'term': term})['count']
+
+
+def test_retry_resumes_at_the_search_term_step(app, monkeypatch):
+    inserts = count_inserts(monkeypatch)
+    rollups = patch_step(monkeypatch, MonthlyRollup, 'apply_expenses')
+    terms = patch_step(monkeypatch, SearchTerm, 'add', failures=1)
+    batch = [item('u1', 10), item('u1', 5)]
+
+    retry = write_pending(batch)
+    assert retry == [('expenses', doc, 2) for _, doc in batch]
+    assert write_pending(retry) == []
+
+    assert inserts == [2]
+    assert rollups == [2]
+    assert terms == [2]
+    assert db.expenses.count_documents({'user_id': 'u1'}) == 2
+    assert MonthlyRollup.check_drift() == []
+    assert term_count('u1') == 2
+
+
+def test_retry_resumes_at_the_rollup_step(app, monkeypatch):
+    inserts = count_inserts(monkeypatch)
+    rollups = patch_step(monkeypatch, MonthlyRollup, 'apply_expenses', failures=1)
+    terms = patch_step(monkeypatch, SearchTerm, 'add')
+
+    queue = WriteBehindQueue(write_pending, retries=3)
+    queue._flush([item('u1', 10), item('u1', 5)])
+
+    assert inserts == [2]
+    assert rollups == [2]
+    assert terms == [2]
+    assert MonthlyRollup.check_drift() == []
+    assert db.monthly_rollups.find_one({'user_id': 'u1'})['debit_total'] == 15
+    assert term_count('u1') == 2
+    assert queue.stats()['flushed'] == 2
+    assert queue.stats()['failed'] == 0
+
+
+def test_insert_that_landed_before_failing_is_not_duplicated(app, monkeypatch):
+    collection_class = type(db.expenses)
+    original = collection_class.insert_many
+    attempts = []
+
+    def insert_many(self, docs, *args, **kwargs):
+        attempts.append(len(docs))
+        result = original(self, docs, *args, **kwargs)
+        if len(attempts) == 1:
+            raise AutoReconnect('reply lost')
+        return result
+
+    monkeypatch.setattr(collection_class, 'insert_many', insert_many)
+    queue = WriteBehindQueue(write_pending, retries=3)
+    queue._flush([item('u1', 4), item('u1', 6)])
+
+    assert len(attempts) == 2
+    assert db.expenses.count_documents({'user_id': 'u1'}) == 2
+    assert MonthlyRollup.check_drift() == []
+    assert term_count('u1') == 2
+
+
+def test_failing_group_does_not_block_other_groups(app, monkeypatch):
+    original = MonthlyRollup.apply_expenses
+
+    def apply_expenses(docs):
+        if docs[0]['user_id'] == 'u1':
+            raise AutoReconnect('connection lost')
+        return original(docs)
+
+    monkeypatch.setattr(MonthlyRollup, 'apply_expenses', staticmethod(apply_expenses))
+    batch = [item('u1', 1), item('u2', 2), item('u2', 3)]
+
+    retry = write_pending(batch)
+    assert retry == [('expenses', batch[0][1], 1)]
+    assert db.expenses.count_documents({'user_id': 'u2'}) == 2
+    assert db.monthly_rollups.find_one({'user_id': 'u2'})['debit_total'] == 5
+    assert term_count('u2') == 2
+
+    # Once the rollup works again only u1's pending steps run
+    monkeypatch.setattr(MonthlyRollup, 'apply_expenses', staticmethod(original))
+    assert write_pending(retry) == []
+    assert db.expenses.count_documents({'user_id': 'u1'}) == 1
+    assert MonthlyRollup.check_drift() == []
+    assert term_count('u1') == 1
+    assert term_count('u2') == 2
+
+
+def test_delete_cancels_a_queued_expense(client, monkeypatch):
+    tokens = register(client)
+    headers = auth_header(tokens['token'])
+    queue = WriteBehindQueue(write_pending, flush_interval=0.2, key_fn=write_behind_key)
+    monkeypatch.setattr(models, '_write_behind', queue)
+
+    client.post('/api/expenses', headers=headers, json={
+        'amount': 3, 'category': 'Food', 'description': 'kept', 'date': '2024-01-05', 'transaction_type': 'DR'
+    }).get_json()['expense']
+    gone = client.post('/api/expenses', headers=headers, json={
+        'amount': 7, 'category': 'Food', 'description': 'gone', 'date': '2024-01-05', 'transaction_type': 'DR'
+    }).get_json()['expense']
+    assert client.delete(f"/api/expenses/{gone['id']}", headers=headers).status_code == 200
+    models.flush_write_behind()
+
+    assert [doc['description'] for doc in db.expenses.find()] == ['kept']
+    assert db.monthly_rollups.find_one({'user_id': tokens['user']['id']})['debit_total'] == 3
+    assert MonthlyRollup.check_drift() == []
+    assert db.search_terms.find_one({'term': 'gone'}) is None
+    assert db.tombstones.count_documents({}) == 0
+    assert queue.stats()['flushed'] == 1
+
+
+def test_cancel_only_matches_the_owner(app, monkeypatch):
+    queue = WriteBehindQueue(write_pending, flush_interval=0.2, key_fn=write_behind_key)
+    monkeypatch.setattr(models, '_write_behind', queue)
+    _, doc = queued = item('u1', 5)
+    queue.put(queued)
+
+    models.Expense.delete(str(doc['_id']), 'u2')
+    models.flush_write_behind()
+    assert db.expenses.count_documents({'_id': doc['_id']}) == 1
+
+
+def test_cancel_waits_for_an_item_being_written(app):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_write(batch):
+        started.set()
+        release.wait(5)
+        return write_pending(batch)
+
+    queue = WriteBehindQueue(slow_write, flush_interval=0.01, key_fn=write_behind_key)
+    queued = item('u1', 5)
+    queue.put(queued)
+    assert started.wait(5)
+
+    results = []
+    canceller = threading.Thread(target=lambda: results.append(queue.cancel(write_behind_key(queued))))
+    canceller.start()
+    canceller.join(0.1)
+    assert canceller.is_alive()
+
+    release.set()
+    canceller.join(5)
+    # Too late to cancel; the document is in the database for the delete
+    assert results == [False]
+    assert db.expenses.count_documents({'_id': queued[1]['_id']}) == 1
+    queue.close()
@@ -0,0 +1,190 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class WriteBehindQueue:
+    # Bounded in-process queue drained by a background thread that hands
+    # batches to `flush_fn`. A batch is flushed once it reaches `batch_size`
+    # items or `flush_interval` seconds after its first item arrived. The
+    # thread is started lazily in the process that first uses the queue, so
+    # it is safe to create before gunicorn forks.
+    #
+    # With `key_fn`, items are tracked by key until they are written so they
+    # can be cancelled (see cancel).
+    def __init__(self, flush_fn, max_size=10000, batch_size=500, flush_interval=0.05,
+                 put_timeout=0.1, retries=3, key_fn=None):
+        self.flush_fn = flush_fn
+        self.key_fn = key_fn
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.retries = retries
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        # key -> 'queued', 'flushing' or 'cancelled'
+        self._keys = {}
+        self._keys_changed = threading.Condition()
+        self.flushed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                # Items and state copied from a parent process belong to it
+                self._queue = queue.Queue(self._queue.maxsize)
+                self._stopping = threading.Event()
+                self._keys = {}
+                self._keys_changed = threading.Condition()
+                self._thread = None
+            if self._thread is None or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                self._thread.start()
+
+    def put(self, item):
+        # Raises QueueFull when the queue stays full for `put_timeout` seconds
+        self._ensure_started()
+        key = self.key_fn(item) if self.key_fn else None
+        if key is not None:
+            with self._keys_changed:
+                self._keys[key] = 'queued'
+        try:
+            self._queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            if key is not None:
+                with self._keys_changed:
+                    self._keys.pop(key, None)
+            self.rejected += 1
+            raise QueueFull('write-behind queue is full')
+
+    def cancel(self, key):
+        # Drop a queued item before it is written. Returns True when it was
+        # still queued. If a flush already has it, waits until it is written
+        # (or given up on) and returns False, so the caller sees it in the
+        # database.
+        if self.key_fn is None:
+            return False
+        with self._keys_changed:
+            state = self._keys.get(key)
+            if state == 'queued':
+                self._keys[key] = 'cancelled'
+                return True
+            if state == 'flushing':
+                self._keys_changed.wait_for(lambda: key not in self._keys)
+            return False
+
+    def _claim(self, batch):
+        # Mark a batch as flushing and leave out cancelled items
+        if self.key_fn is None:
+            return batch
+        claimed = []
+        with self._keys_changed:
+            for item in batch:
+                key = self.key_fn(item)
+                if self._keys.get(key) == 'cancelled':
+                    del self._keys[key]
+                    continue
+                self._keys[key] = 'flushing'
+                claimed.append(item)
+            self._keys_changed.notify_all()
+        return claimed
+
+    def _release(self, batch):
+        if self.key_fn is None:
+            return
+        with self._keys_changed:
+            for item in batch:
+                self._keys.pop(self.key_fn(item), None)
+            self._keys_changed.notify_all()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        # flush_fn returns the items it could not write, possibly rewritten to
+        # say where to resume; only those are retried. If it raises, the
+        # whole batch is retried.
+        batch = self._claim(batch)
+        if not batch:
+            return
+        try:
+            self._attempt(batch)
+        finally:
+            self._release(batch)
+
+    def _attempt(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                remaining = self.flush_fn(batch) or []
+            except Exception:
+                logger.exception('Write-behind flush of %d items failed', len(batch))
+                remaining = batch
+            self.flushed += len(batch) - len(remaining)
+            if not remaining:
+                return
+            batch = remaining
+            if attempt == self.retries:
+                self.failed += len(batch)
+                logger.error('Dropping %d write-behind items after %d attempts', len(batch), attempt + 1)
+                return
+            time.sleep(0.1 * 2 ** attempt)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._flush(self._collect(first))
+
+    def close(self, timeout=10):
+        # Stop the background thread and flush whatever is still queued
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'flushed': self.flushed,
+            'failed': self.failed,
+            'rejected': self.rejected
+        }